@@ -1,10 +1,57 @@
-from fastapi import FastAPI
+import asyncio
+import json
+import threading
+import time
+from fastapi import FastAPI, HTTPException, Query
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse
 from pydantic import BaseModel
 from fastapi.middleware.cors import CORSMiddleware
-from langgraph_workflow import build_graph
+from config import BATCH_CONCURRENCY, BATCH_MAX_ITEMS
+from embedding_service import get_embedding_service
+from llm_cache import get_llm_cache
+from sqlite_pool import pool_stats, stream, PoolExhausted, QueryTimeout
+import result_store
+from logger import log_stats
+import metrics
+import warmup
 
 app = FastAPI()
-graph = build_graph()
+started_at = time.time()
+
+# The graph (langgraph, openai, main) is built on first use or by the warm-up, not at import
+_graph = None
+_graph_lock = threading.Lock()
+
+def get_graph():
+    global _graph
+    if _graph is None:
+        with _graph_lock:
+            if _graph is None:
+                from langgraph_workflow import build_graph
+                _graph = build_graph()
+    return _graph
+
+async def aget_graph():
+    # Off the event loop while the graph is still being built
+    return _graph if _graph is not None else await asyncio.to_thread(get_graph)
+
+@app.on_event("startup")
+def start_warm_up():
+    # Models, routing matrix (mapped once per worker) and clients load in the background;
+    # /readyz turns 200 once the required steps are done
+    if warmup.WARMUP_ON_STARTUP:
+        warmup.start_warm_up([("graph", get_graph, True)])
+
+@app.get("/healthz")
+def healthz():
+    return {"status": "ok", "uptime_seconds": round(time.time() - started_at, 1)}
+
+@app.get("/readyz")
+def readyz():
+    if not warmup.WARMUP_ON_STARTUP:
+        return {"ready": True, "warmup": "disabled"}
+    status = warmup.readiness()
+    return JSONResponse(status, status_code=200 if status["ready"] else 503)
 
 app.add_middleware(
     CORSMiddleware,
@@ -17,31 +64,191 @@ app.add_middleware(
 class QueryRequest(BaseModel):
     question: str
     db_id: str = None  # Optional, override if needed
+    trace: bool = False  # Include per-span timings in the response
+
+class BatchQueryRequest(BaseModel):
+    questions: list[QueryRequest]
+    concurrency: int = None  # Defaults to (and is capped at) BATCH_CONCURRENCY
+
+def initial_state_for(data: QueryRequest):
+    from langgraph_workflow import initial_state
+    return initial_state(data.question, data.db_id)
+
+def response_for(result):
+    return {
+    "result": result.get("output", "No meaningful answer found."),
+    "db": result.get("final_db", None),
+    "sql": result.get("final_sql", None),
+    "candidates": result.get("gpt_selected_dbs", []),
+    "timings": result.get("db_timings", {}),
+    "result_id": result.get("final_result_id"),
+    "rows_url": f"/query/{result['final_result_id']}/rows" if result.get("final_result_id") else None,
+    "decisions": result.get("decisions", {})
+    }
 
 @app.post("/query")
-def query_handler(data: QueryRequest):
+async def query_handler(data: QueryRequest):
     try:
-        initial_state = {
-            "question": data.question,
-            "dbs": [data.db_id] if data.db_id else [],
-            "output": "",
-            "attempt": 0,
-            "hinted_db": None,
-            "hinted_column": None,
-            "gpt_selected_dbs": [],
-            "all_outputs": {},
-            "final_db": None,
-            "final_sql": None
-        }
-
-        result = graph.invoke(initial_state)
-
-        return {
-        "result": result.get("output", "No meaningful answer found."),
-        "db": result.get("final_db", None),
-        "sql": result.get("final_sql", None),
-        "candidates": result.get("gpt_selected_dbs", [])
-        }
+        started = time.perf_counter()
+        with metrics.collect_trace(data.trace) as trace:
+            graph = await aget_graph()
+            result = await graph.ainvoke(initial_state_for(data))
+        metrics.REQUESTS.observe(time.perf_counter() - started, endpoint="/query")
+
+        response = response_for(result)
+        if trace is not None:
+            response["trace"] = trace
+        return response
 
     except Exception as e:
         return {"error": str(e)}
+
+# What each node's completion tells the client, as (event name, state fields)
+STAGE_EVENTS = {
+    "embed_question": ("stage", []),
+    "extract_context": ("hints", ["hinted_db", "hinted_column"]),
+    "route_databases": ("routing", ["dbs", "decisions"]),
+    "select_databases_with_gpt": ("candidates", ["gpt_selected_dbs"]),
+    "retrieve_schema": ("dbs", ["dbs"]),
+    "generate_sql_multi": ("stage", ["db_timings"]),
+    "select_best_answer": ("chosen", ["final_db", "final_sql", "final_result_id"]),
+    "pick_single_answer": ("chosen", ["final_db", "final_sql", "final_result_id"]),
+    "final_output": ("stage", []),
+    "final_output_direct": ("stage", []),
+}
+
+def sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+@app.post("/query/stream")
+async def query_stream(data: QueryRequest):
+    # Server-sent events: one per finished node, one per DB result, answer_delta tokens
+    # (answer_reset if the stream fails part-way), then done
+    async def events():
+        started = time.perf_counter()
+        yield sse("start", {"question": data.question})
+        try:
+            graph = await aget_graph()
+            result = initial_state_for(data)
+            # stream_answer: final_output streams answer_delta tokens (other runs make a retryable call)
+            config = {"configurable": {"stream_answer": True}}
+            async for mode, chunk in graph.astream(result, config, stream_mode=["updates", "custom"]):
+                elapsed_ms = round((time.perf_counter() - started) * 1000, 1)
+                if mode == "custom":
+                    yield sse(chunk["event"], {**chunk, "elapsed_ms": elapsed_ms})
+                    continue
+                for node, update in chunk.items():
+                    result = {**result, **(update or {})}
+                    event, fields = STAGE_EVENTS.get(node, ("stage", []))
+                    yield sse(event, {"node": node, "elapsed_ms": elapsed_ms, **{f: result.get(f) for f in fields}})
+            yield sse("done", response_for(result))
+        except Exception as e:
+            yield sse("error", {"error": str(e)})
+        finally:
+            metrics.REQUESTS.observe(time.perf_counter() - started, endpoint="/query/stream")
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.post("/query/batch")
+async def query_batch(data: BatchQueryRequest):
+    if len(data.questions) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"At most {BATCH_MAX_ITEMS} questions per batch")
+    from batch_query import plan_batch, run_batch
+    # A client may ask for less parallelism, never more than the server allows
+    concurrency = min(data.concurrency or BATCH_CONCURRENCY, BATCH_CONCURRENCY)
+    started = time.perf_counter()
+    items = [(q.question, q.db_id) for q in data.questions]
+    graph = await aget_graph()
+    unique, groups = await asyncio.to_thread(plan_batch, items)
+
+    async def ndjson():
+        # First line: the batch plan; then one line per submitted question as its answer lands;
+        # duplicates share the run of their first occurrence
+        yield json.dumps({
+            "items": len(items),
+            "unique": len(unique),
+            "groups": {db_id or "unrouted": len(members) for db_id, members in groups.items()},
+        }) + "\n"
+        try:
+            async for n, state, error, seconds in run_batch(graph, unique, groups, concurrency):
+                first = unique[n]["indices"][0]
+                body = {"error": error} if error else response_for(state)
+                for index in unique[n]["indices"]:
+                    line = {"index": index, "question": items[index][0], "seconds": round(seconds, 3)}
+                    if index != first:
+                        line["duplicate_of"] = first
+                    yield json.dumps({**line, **body}, default=str) + "\n"
+            yield json.dumps({"done": True, "seconds": round(time.perf_counter() - started, 3)}) + "\n"
+        finally:
+            metrics.REQUESTS.observe(time.perf_counter() - started, endpoint="/query/batch")
+
+    return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+
+@app.get("/query/{result_id}/rows")
+def query_rows(result_id: str, offset: int = Query(0, ge=0), limit: int = Query(1000, ge=1, le=10000)):
+    entry = result_store.get(result_id)
+    if entry is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired result id")
+
+    # The page's query runs before the response starts, so a bad query or a busy pool is a
+    # proper error status rather than a broken 200 stream
+    if entry["max_rows"]:
+        # The guard downgraded this query: page only within its row cap
+        limit = max(0, min(limit, entry["max_rows"] - offset))
+    chunks = stream(entry["db_path"], entry["sql"], offset=offset, limit=limit, timeout=entry["timeout"])
+    try:
+        columns = next(chunks)
+    except PoolExhausted as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except QueryTimeout as e:
+        raise HTTPException(status_code=504, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Query failed: {e}")
+
+    def ndjson():
+        # First line: columns + paging info; then one JSON array per row, sent in chunks
+        yield json.dumps({"columns": columns, "offset": offset, "limit": limit, "db": entry["db_id"], "max_rows": entry["max_rows"] or None}) + "\n"
+        for rows in chunks:
+            yield "".join(json.dumps(list(row), default=str) + "\n" for row in rows)
+
+    return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+
+@app.get("/stats/embedding")
+def embedding_stats():
+    return get_embedding_service().stats()
+
+@app.get("/stats/llm_cache")
+def llm_cache_stats():
+    return get_llm_cache().stats()
+
+@app.get("/stats/sqlite")
+def sqlite_stats():
+    return pool_stats()
+
+@app.get("/stats/log")
+def result_log_stats():
+    return log_stats()
+
+def runtime_gauges():
+    samples = []
+    for key, value in get_embedding_service().stats().items():
+        samples.append((f"text2sql_embedding_{key}", {}, value))
+    for key, value in get_llm_cache().stats().items():
+        samples.append((f"text2sql_llm_cache_{key}", {}, value))
+    for db_id, stats in pool_stats().items():
+        for key, value in stats.items():
+            samples.append((f"text2sql_sqlite_{key}", {"db_id": db_id}, value))
+    for filename, stats in log_stats().items():
+        for key, value in stats.items():
+            samples.append((f"text2sql_log_{key}", {"file": filename}, value))
+    return samples
+
+metrics.register_gauges(runtime_gauges)
+
+@app.get("/metrics")
+def prometheus_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
@@ -0,0 +1,95 @@
+import asyncio
+import re
+import time
+from config import BATCH_CONCURRENCY
+from db_router import top_k_databases
+from embedding_service import get_embedding_service
+from langgraph_workflow import initial_state
+from main import SPIDER_PATH, RETRIEVAL_K, schema_retriever
+from metrics import Counter, register_metric, span
+
+BATCH_ITEMS = register_metric(
+    Counter("text2sql_batch_items_total", "Questions received by /query/batch, and the unique ones run", ("kind",))
+)
+
+_SPACE = re.compile(r"\s+")
+
+
+def normalize_question(question):
+    # "  How many  singers? " and "how many singers" run once
+    return _SPACE.sub(" ", question).strip().rstrip("?!. ").lower()
+
+
+def plan_batch(items):
+    # items: [(question, db_id)] -> unique questions, their embeddings and per-DB groups.
+    # Every unique question is embedded in one encode call and routed on the mapped matrix.
+    unique, indices, seen = [], [], {}
+    for i, (question, db_id) in enumerate(items):
+        key = (normalize_question(question), db_id or None)
+        if key not in seen:
+            seen[key] = len(unique)
+            unique.append({"question": question, "db_id": db_id or None, "indices": []})
+        unique[seen[key]]["indices"].append(i)
+        indices.append(seen[key])
+
+    with span("batch", "embed", texts=len(unique)):
+        embeddings = get_embedding_service().encode([item["question"] for item in unique], normalize=True)
+    embeddings.setflags(write=False)
+
+    groups = {}
+    for n, item in enumerate(unique):
+        item["embedding"] = embeddings[n]
+        db_id = item["db_id"]
+        if not db_id:
+            try:
+                db_id = top_k_databases(item["embedding"], k=1)[0][1]
+            except Exception:
+                db_id = None
+        item["group"] = db_id
+        groups.setdefault(db_id, []).append(n)
+
+    BATCH_ITEMS.inc(len(items), kind="received")
+    BATCH_ITEMS.inc(len(unique), kind="unique")
+    return unique, groups
+
+
+def warm_database(db_id, embeddings):
+    # Load the snapshot and chunk index once and pre-fetch every question's chunks in one
+    # collection query; run_query_with_result then hits the retrieval cache
+    try:
+        with span("batch", "warm", db=db_id, questions=len(embeddings)):
+            db_path = f"{SPIDER_PATH}/{db_id}/{db_id}.sqlite"
+            schema_retriever(db_id, db_path).retrieve_many(embeddings, k=RETRIEVAL_K)
+    except Exception as e:
+        print(f"⚠️ Batch warm-up failed for {db_id}: {e}")
+
+
+async def run_batch(graph, unique, groups, concurrency=BATCH_CONCURRENCY):
+    # Yields (unique index, final state, error, seconds) as each question finishes
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    warmups = {
+        db_id: asyncio.create_task(asyncio.to_thread(warm_database, db_id, [unique[n]["embedding"] for n in members]))
+        for db_id, members in groups.items()
+        if db_id
+    }
+
+    async def run_one(n):
+        item = unique[n]
+        async with semaphore:
+            if item["group"] in warmups:
+                await warmups[item["group"]]
+            started = time.perf_counter()
+            try:
+                state = await graph.ainvoke(initial_state(item["question"], item["db_id"], item["embedding"]))
+                return n, state, None, time.perf_counter() - started
+            except Exception as e:
+                return n, None, str(e), time.perf_counter() - started
+
+    # Submit group by group so questions on the same DB run back to back
+    tasks = [asyncio.create_task(run_one(n)) for members in groups.values() for n in members]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks + list(warmups.values()):
+            task.cancel()
@@ -1,22 +1,253 @@
+# Offline runner: pushes a question manifest through the pipeline on a worker pool under the
+# process-wide LLM rate limit, checkpointing every finished item so a crash or Ctrl-C resumes
+# where it stopped. The first Ctrl-C stops handing out items and waits for the in-flight ones
+# (checkpointing their results); a second one abandons them.
+#
+#   python batch_runner.py questions.jsonl --output runs/dev.results.jsonl --workers 16 --rpm 3000
+#   python batch_runner.py spider/dev.json --retry-errors
+#
+# Items with a db_id go straight to run_query_with_result; items without one run the full graph.
+import argparse
+import csv
+import hashlib
+import json
 import os
-from main import run_query  # assuming you refactor main.py to expose a function
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from config import LLM_REQUESTS_PER_MINUTE, LLM_TOKENS_PER_MINUTE
 
-def list_databases(base_path="spider/databases"):
-    return sorted([
-        name for name in os.listdir(base_path)
-        if os.path.isdir(os.path.join(base_path, name))
-    ])
+BATCH_WORKERS = int(os.getenv("BATCH_WORKERS", "8"))
+PROGRESS_EVERY = float(os.getenv("BATCH_PROGRESS_SECONDS", "10"))
+# Checkpoint lines are flushed as they land and fsynced at most this often
+FSYNC_EVERY = float(os.getenv("BATCH_FSYNC_SECONDS", "5"))
 
-if __name__ == "__main__":
-    user_question = "Show all students enrolled in 2020."
 
-    all_dbs = list_databases()
-    for db_id in all_dbs:
-        print("="*60)
-        print(f"🟡 Running on database: {db_id}")
-        print("-"*60)
+def load_manifest(path):
+    # JSONL, Spider-style JSON or CSV rows with question and optional db_id / id.
+    # Without an id, items are keyed by content (plus occurrence) so reordering the manifest is safe.
+    if path.endswith(".json"):
+        with open(path) as f:
+            rows = json.load(f)
+    elif path.endswith(".jsonl"):
+        with open(path) as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+    else:
+        csv.field_size_limit(1 << 30)
+        with open(path, newline="") as f:
+            rows = [row for row in csv.DictReader(f) if row.get("question")]
+
+    items, occurrences = [], {}
+    for row in rows:
+        db_id = row.get("db_id") or None
+        item_id = row.get("id")
+        if item_id in (None, ""):
+            digest = hashlib.sha1(f"{db_id or ''}\0{row['question']}".encode()).hexdigest()[:16]
+            occurrences[digest] = occurrences.get(digest, 0) + 1
+            item_id = digest if occurrences[digest] == 1 else f"{digest}#{occurrences[digest]}"
+        items.append({"id": str(item_id), "db_id": db_id, "question": row["question"]})
+    return items
+
+
+def load_checkpoint(path, retry_errors=False):
+    # ids already in the output file. Only a torn last line (a crash mid-write) is cut off;
+    # malformed lines elsewhere are skipped and reported, and their items run again.
+    done = set()
+    if not os.path.exists(path):
+        return done
+    malformed, torn, unterminated = 0, None, False
+    with open(path, "rb+") as f:
+        end = 0
+        for line in f:
+            start, end = end, end + len(line)
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+                item_id = str(record["id"])
+            except (ValueError, KeyError, TypeError):
+                if line.endswith(b"\n"):
+                    malformed += 1
+                else:
+                    torn = start
+                continue
+            # A complete record without its newline would be glued to the next append
+            unterminated = not line.endswith(b"\n")
+            if not (retry_errors and record.get("error")):
+                done.add(item_id)
+        if torn is not None:
+            f.truncate(torn)
+        elif unterminated:
+            f.seek(0, os.SEEK_END)
+            f.write(b"\n")
+    if malformed:
+        print(f"⚠️ Skipped {malformed} malformed lines in {path}; their items will run again")
+    return done
+
+
+def format_eta(seconds):
+    if seconds is None:
+        return "?"
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h{minutes:02d}m" if hours else f"{minutes}m{seconds:02d}s"
+
+
+def make_runner(needs_graph, stop):
+    # Heavy imports only once there is work to do; the graph only when some item has no db_id.
+    # Once stop is set, items that haven't started yet return None and are rerun on resume.
+    from main import run_query_with_result, answer_error
+    if needs_graph:
+        from langgraph_workflow import build_graph, initial_state
+        graph = build_graph()
+
+    def run_item(item):
+        if stop.is_set():
+            return None
+        started = time.perf_counter()
+        if item["db_id"]:
+            sql, answer, result_id = run_query_with_result(item["db_id"], item["question"])
+            db_id = item["db_id"]
+            error = answer_error(sql, answer)
+        else:
+            state = graph.invoke(initial_state(item["question"]))
+            sql, answer, db_id = state.get("final_sql"), state.get("output"), state.get("final_db")
+            result_id = state.get("final_result_id")
+            error = None if db_id else answer
+        return {
+            "id": item["id"],
+            "db_id": db_id,
+            "question": item["question"],
+            "sql": sql,
+            "answer": answer,
+            "result_id": result_id,
+            "error": error,
+            "seconds": round(time.perf_counter() - started, 3),
+        }
+
+    return run_item
+
+
+def run(items, output, workers=BATCH_WORKERS, retry_errors=False):
+    done = load_checkpoint(output, retry_errors)
+    todo = [item for item in items if item["id"] not in done]
+    total = len(items)
+    print(f"📋 {total} items, {total - len(todo)} already done, {len(todo)} to run on {workers} workers → {output}")
+    if not todo:
+        return {"total": total, "ran": 0, "errors": 0, "interrupted": False, "aborted": False}
+
+    stop = threading.Event()
+    run_item = make_runner(any(not item["db_id"] for item in todo), stop)
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    out = open(output, "a")
+    started = last_progress = last_fsync = time.perf_counter()
+    finished = errors = 0
+    interrupted = aborted = False
+
+    def progress(final=False):
+        elapsed = time.perf_counter() - started
+        rate = finished / elapsed if elapsed > 0 else 0.0
+        eta = (len(todo) - finished) / rate if rate > 0 else None
+        completed = total - len(todo) + finished
+        label = "✅ Finished" if final else "📊"
+        print(
+            f"{label} {completed}/{total} ({completed / total:.1%}) · {rate:.2f} items/s · "
+            f"ETA {format_eta(0 if final else eta)} · errors {errors} · elapsed {format_eta(elapsed)}"
+        )
+
+    def checkpoint(future, item):
+        nonlocal finished, errors
         try:
-            run_query(db_id, user_question)
+            record = future.result()
         except Exception as e:
-            print(f"❌ Failed on {db_id}: {e}")
-        print("="*60)
+            record = {"id": item["id"], "db_id": item["db_id"], "question": item["question"], "error": str(e)}
+        if record is None:
+            return  # skipped after stop
+        errors += bool(record.get("error"))
+        finished += 1
+        out.write(json.dumps(record, default=str) + "\n")
+
+    # Keep a bounded window in flight so tens of thousands of items don't all become futures
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="batch")
+    queue = iter(todo)
+    pending = {}
+    try:
+        for item in queue:
+            pending[executor.submit(run_item, item)] = item
+            if len(pending) >= workers * 2:
+                break
+
+        while pending:
+            ready, _ = wait(pending, timeout=PROGRESS_EVERY, return_when=FIRST_COMPLETED)
+            for future in ready:
+                checkpoint(future, pending.pop(future))
+                next_item = next(queue, None)
+                if next_item is not None:
+                    pending[executor.submit(run_item, next_item)] = next_item
+            out.flush()
+
+            now = time.perf_counter()
+            if now - last_fsync >= FSYNC_EVERY:
+                os.fsync(out.fileno())
+                last_fsync = now
+            if now - last_progress >= PROGRESS_EVERY:
+                progress()
+                last_progress = now
+    except KeyboardInterrupt:
+        # Queued items are dropped and rerun on resume; running ones finish and are checkpointed
+        interrupted = True
+        stop.set()
+        for future in list(pending):
+            if future.cancel():
+                del pending[future]
+        try:
+            if pending:
+                print(f"\n🛑 Interrupted. Waiting for {len(pending)} in-flight items (Ctrl-C again to abandon them)...")
+            while pending:
+                ready, _ = wait(pending, timeout=PROGRESS_EVERY, return_when=FIRST_COMPLETED)
+                for future in ready:
+                    checkpoint(future, pending.pop(future))
+                out.flush()
+        except KeyboardInterrupt:
+            aborted = True
+            print(f"🛑 Abandoned {len(pending)} in-flight items; they rerun on resume.")
+        print("🛑 Rerun the same command to resume.")
+    finally:
+        stop.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+        out.flush()
+        os.fsync(out.fileno())
+        out.close()
+
+    progress(final=not interrupted)
+    return {"total": total, "ran": finished, "errors": errors, "interrupted": interrupted, "aborted": aborted}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run a question manifest through the pipeline, resumably.")
+    parser.add_argument("manifest", help="JSONL, Spider JSON or CSV with question and optional db_id / id")
+    parser.add_argument("--output", help="Checkpoint/results JSONL (default: <manifest>.results.jsonl)")
+    parser.add_argument("--workers", type=int, default=BATCH_WORKERS)
+    parser.add_argument("--rpm", type=float, default=LLM_REQUESTS_PER_MINUTE, help="Global LLM requests per minute")
+    parser.add_argument("--tpm", type=float, default=LLM_TOKENS_PER_MINUTE, help="Global LLM tokens per minute")
+    parser.add_argument("--limit", type=int, help="Only the first N manifest items")
+    parser.add_argument("--retry-errors", action="store_true", help="Rerun items whose checkpointed result is an error")
+    args = parser.parse_args(argv)
+
+    # One limiter for every worker thread (and the graph's own fan-out)
+    import model_runner
+    model_runner.limiter = model_runner.RateLimiter(args.rpm, args.tpm)
+
+    items = load_manifest(args.manifest)[:args.limit]
+    output = args.output or os.path.splitext(args.manifest)[0] + ".results.jsonl"
+    summary = run(items, output, workers=max(1, args.workers), retry_errors=args.retry_errors)
+    if summary["aborted"]:
+        # Abandoned workers are non-daemon threads; don't wait for them at interpreter exit
+        sys.stdout.flush()
+        os._exit(130)
+    return 130 if summary["interrupted"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
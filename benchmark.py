@@ -0,0 +1,358 @@
+# End-to-end benchmark: replays a question workload against run_query or the /query API
+# with a deterministic fake LLM, and writes a JSON report for comparing commits.
+#
+#   python benchmark.py --workload results_log.csv --target run_query --concurrency 8 --limit 200
+#   python benchmark.py --workload spider/dev.json --target api --fake-latency lognormal:300:0.4
+#   python benchmark.py --target cold_start --runs 5
+#   python benchmark.py --compare bench_results/a.json bench_results/b.json
+import argparse
+import asyncio
+import csv
+import json
+import os
+import platform
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+BENCH_DIR = "bench_results"
+# Entry points whose cold import is tracked: the server, the CLI and the workflow
+COLD_START_MODULES = ("api", "main", "langgraph_workflow")
+
+# Runs in a fresh interpreter: times the import (and optionally the warm-up), lists files it created
+COLD_START_PROBE = """
+import json, os, sys, time
+before = set(os.listdir("."))
+started = time.perf_counter()
+import {module}
+imported = time.perf_counter()
+report = {{"import_s": imported - started, "created_files": sorted(set(os.listdir(".")) - before)}}
+if {warm}:
+    import warmup
+    status = warmup.warm_up([("graph", {module}.get_graph, True)])
+    report["warmup_s"] = time.perf_counter() - imported
+    report["ready"] = status["ready"]
+print("COLD_START " + json.dumps(report))
+"""
+
+
+def load_workload(path, limit=None, seed=0, unique=False):
+    # Accepts Spider-style JSON (list of {db_id, question}), JSONL, or a CSV with db_id/question columns
+    items = []
+    if path.endswith(".json"):
+        with open(path) as f:
+            items = [{"db_id": r.get("db_id"), "question": r["question"]} for r in json.load(f)]
+    elif path.endswith(".jsonl"):
+        with open(path) as f:
+            items = [{"db_id": r.get("db_id"), "question": r["question"]} for r in map(json.loads, f) if r]
+    else:
+        csv.field_size_limit(1 << 30)
+        with open(path, newline="") as f:
+            items = [{"db_id": r.get("db_id") or None, "question": r["question"]} for r in csv.DictReader(f) if r.get("question")]
+
+    if unique:
+        seen = set()
+        items = [i for i in items if (i["db_id"], i["question"]) not in seen and not seen.add((i["db_id"], i["question"]))]
+    random.Random(seed).shuffle(items)
+    return items[:limit] if limit else items
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    pos = (len(ordered) - 1) * q
+    lo, hi = int(pos), min(int(pos) + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (pos - lo)
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_fake_llm(latency, error_rate, seed):
+    import uvicorn
+    import fake_openai_server
+
+    fake_openai_server.configure(latency=latency, error_rate=error_rate, seed=seed)
+    port = _free_port()
+    server = uvicorn.Server(uvicorn.Config(fake_openai_server.app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, name="fake-llm", daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return f"http://127.0.0.1:{port}/v1"
+
+
+def _stage_name(span):
+    # Collapse high-cardinality span names (db ids, model names) into one stage per kind
+    if span["kind"] in ("node", "embedding"):
+        return f"{span['kind']}:{span['name']}"
+    return span["kind"]
+
+
+def run_query_target(items, concurrency):
+    import metrics
+    from main import run_query
+
+    def one(item):
+        started = time.perf_counter()
+        error = None
+        with metrics.collect_trace() as trace:
+            try:
+                sql, answer = run_query(item["db_id"], item["question"])
+                if sql == "SQL generation failed":
+                    error = answer
+            except Exception as e:
+                error = str(e)
+        return {"latency": time.perf_counter() - started, "error": error, "spans": trace}
+
+    items = [i for i in items if i["db_id"]]
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return list(executor.map(one, items))
+
+
+async def api_target(items, concurrency, api_url=None):
+    import httpx
+
+    if api_url:
+        client = httpx.AsyncClient(base_url=api_url, timeout=600)
+    else:
+        import api
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=api.app), base_url="http://benchmark", timeout=600)
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(item):
+        async with semaphore:
+            started = time.perf_counter()
+            payload = {"question": item["question"], "trace": True}
+            if item.get("db_id"):
+                payload["db_id"] = item["db_id"]
+            try:
+                response = await client.post("/query", json=payload)
+                body = response.json()
+                error = body.get("error") or (None if response.status_code == 200 else response.text)
+                spans = body.get("trace") or []
+            except Exception as e:
+                error, spans = str(e), []
+            return {"latency": time.perf_counter() - started, "error": error, "spans": spans}
+
+    async with client:
+        return await asyncio.gather(*(one(item) for item in items))
+
+
+def _heaviest_imports(module, env, top=10):
+    # -X importtime self time summed per top-level package
+    output = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, env=env,
+    ).stderr
+    packages = {}
+    for line in output.splitlines():
+        parts = line.split("|")
+        self_us = parts[0].split(":")[-1].strip()
+        if len(parts) != 3 or not self_us.isdigit():
+            continue
+        package = parts[2].strip().split(".")[0]
+        packages[package] = packages.get(package, 0) + int(self_us)
+    ranked = sorted(packages.items(), key=lambda item: -item[1])[:top]
+    return {package: round(us / 1000, 1) for package, us in ranked}
+
+
+def cold_start_target(runs, warm=False):
+    # Every run is a new interpreter, so nothing is shared through sys.modules
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [os.path.dirname(os.path.abspath(__file__)), env.get("PYTHONPATH")]))
+    samples = {module: [] for module in COLD_START_MODULES}
+    warmups, created, ready = [], {}, []
+    for _ in range(runs):
+        for module in COLD_START_MODULES:
+            probe = COLD_START_PROBE.format(module=module, warm=warm and module == "api")
+            started = time.perf_counter()
+            result = subprocess.run([sys.executable, "-c", probe], capture_output=True, text=True, env=env)
+            line = next((l for l in result.stdout.splitlines() if l.startswith("COLD_START ")), None)
+            if line is None:
+                print(f"❌ Cold import of {module} failed:\n{result.stderr[-2000:]}")
+                continue
+            report = json.loads(line[len("COLD_START "):])
+            samples[module].append({"import_s": report["import_s"], "process_s": time.perf_counter() - started})
+            created[module] = report["created_files"]
+            if "warmup_s" in report:
+                warmups.append(report["warmup_s"])
+                ready.append(report["ready"])
+    return {"samples": samples, "warmups": warmups, "ready": ready, "created": created, "env": env}
+
+
+def summarize_cold_start(results):
+    ms = lambda v: round(v * 1000, 1) if v is not None else None
+    summary = {
+        "runs": max((len(v) for v in results["samples"].values()), default=0),
+        "cold_start_ms": {
+            module: {
+                "import_p50": ms(percentile([r["import_s"] for r in runs], 0.5)),
+                "import_max": ms(max((r["import_s"] for r in runs), default=None)),
+                "process_p50": ms(percentile([r["process_s"] for r in runs], 0.5)),
+            }
+            for module, runs in results["samples"].items()
+        },
+        # Importing should never touch the disk; anything listed here is an import-time side effect
+        "import_created_files": results["created"],
+        "heaviest_imports_ms": _heaviest_imports("api", results["env"]),
+    }
+    if results["warmups"]:
+        summary["warmup_ms"] = {"p50": ms(percentile(results["warmups"], 0.5)), "ready": all(results["ready"])}
+    return summary
+
+
+def summarize(results, wall_seconds):
+    latencies = [r["latency"] for r in results]
+    stage_totals = {}
+    llm_calls = []
+    for r in results:
+        per_stage = {}
+        for span in r["spans"] or []:
+            name = _stage_name(span)
+            per_stage[name] = per_stage.get(name, 0.0) + span["duration_ms"]
+        for name, ms in per_stage.items():
+            stage_totals.setdefault(name, []).append(ms)
+        llm_calls.append(sum(1 for span in r["spans"] or [] if span["kind"] == "llm"))
+
+    ms = lambda v: round(v * 1000, 1) if v is not None else None
+    return {
+        "questions": len(results),
+        "errors": sum(1 for r in results if r["error"]),
+        "wall_seconds": round(wall_seconds, 3),
+        "qps": round(len(results) / wall_seconds, 3) if wall_seconds else None,
+        "latency_ms": {
+            "p50": ms(percentile(latencies, 0.50)),
+            "p95": ms(percentile(latencies, 0.95)),
+            "p99": ms(percentile(latencies, 0.99)),
+            "mean": ms(sum(latencies) / len(latencies)) if latencies else None,
+            "max": ms(max(latencies)) if latencies else None,
+        },
+        "stages_ms": {
+            name: {"p50": round(percentile(v, 0.5), 1), "mean": round(sum(v) / len(v), 1), "questions": len(v)}
+            for name, v in sorted(stage_totals.items())
+        },
+        "llm_calls_per_question": round(sum(llm_calls) / len(llm_calls), 2) if llm_calls else None,
+        # ru_maxrss is KiB on Linux, bytes on macOS
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1),
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True, stderr=subprocess.DEVNULL).strip()
+    except Exception:
+        return "unknown"
+
+
+def compare(old_path, new_path):
+    with open(old_path) as f:
+        old = json.load(f)["summary"]
+    with open(new_path) as f:
+        new = json.load(f)["summary"]
+
+    if "cold_start_ms" in old and "cold_start_ms" in new:
+        rows = []
+        for module in sorted(set(old["cold_start_ms"]) | set(new["cold_start_ms"])):
+            for key in ("import_p50", "process_p50"):
+                rows.append((f"{module} {key} ms", old["cold_start_ms"].get(module, {}).get(key), new["cold_start_ms"].get(module, {}).get(key)))
+        rows.append(("warm-up p50 ms", old.get("warmup_ms", {}).get("p50"), new.get("warmup_ms", {}).get("p50")))
+        _print_rows(rows)
+        return
+
+    rows = [("qps", old["qps"], new["qps"])]
+    rows += [(f"latency {k}", old["latency_ms"][k], new["latency_ms"][k]) for k in ("p50", "p95", "p99")]
+    rows += [("llm calls/question", old["llm_calls_per_question"], new["llm_calls_per_question"])]
+    rows += [("peak rss MB", old["peak_rss_mb"], new["peak_rss_mb"])]
+    for stage in sorted(set(old["stages_ms"]) | set(new["stages_ms"])):
+        rows.append((f"{stage} p50", old["stages_ms"].get(stage, {}).get("p50"), new["stages_ms"].get(stage, {}).get("p50")))
+
+    _print_rows(rows)
+
+
+def _print_rows(rows):
+    for name, a, b in rows:
+        delta = f"{(b - a) / a * 100:+.1f}%" if a and b is not None else ""
+        print(f"{name:<40} {a!s:>12} {b!s:>12} {delta:>9}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Text2SQL latency/throughput benchmark")
+    parser.add_argument("--workload", default="results_log.csv")
+    parser.add_argument("--target", choices=["run_query", "api", "cold_start"], default="run_query")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--limit", type=int, default=100)
+    parser.add_argument("--unique", action="store_true", help="Drop repeated (db_id, question) pairs")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--api-url", default=None, help="Benchmark a running server instead of the in-process app")
+    parser.add_argument("--real-llm", action="store_true", help="Use the configured OpenAI endpoint instead of the fake")
+    parser.add_argument("--fake-latency", default="lognormal:250:0.3")
+    parser.add_argument("--fake-error-rate", type=float, default=0.0)
+    parser.add_argument("--keep-cache", action="store_true", help="Use the real LLM cache and result log")
+    parser.add_argument("--runs", type=int, default=5, help="cold_start: fresh interpreters per module")
+    parser.add_argument("--warm", action="store_true", help="cold_start: also time warmup.warm_up() after importing api")
+    parser.add_argument("--output", default=None)
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"))
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    # Must happen before the pipeline modules are imported: they read these at import time
+    if not args.keep_cache:
+        scratch = tempfile.mkdtemp(prefix="text2sql-bench-")
+        os.environ["LLM_CACHE_PATH"] = os.path.join(scratch, "llm_cache.sqlite")
+        os.environ["RESULTS_LOG"] = os.path.join(scratch, "results.csv")
+    if not args.real_llm and not args.api_url and args.target != "cold_start":
+        os.environ["OPENAI_BASE_URL"] = start_fake_llm(args.fake_latency, args.fake_error_rate, args.seed)
+        os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+
+    if args.target == "cold_start":
+        print(f"🏁 Cold start: {', '.join(COLD_START_MODULES)} × {args.runs} runs")
+        summary = summarize_cold_start(cold_start_target(args.runs, args.warm))
+    else:
+        items = load_workload(args.workload, args.limit, args.seed, args.unique)
+        print(f"🏁 {len(items)} questions → {args.target} (concurrency {args.concurrency})")
+
+        started = time.perf_counter()
+        if args.target == "run_query":
+            results = run_query_target(items, args.concurrency)
+        else:
+            results = asyncio.run(api_target(items, args.concurrency, args.api_url))
+        summary = summarize(results, time.perf_counter() - started)
+
+    report = {
+        "meta": {
+            "commit": _git_commit(),
+            "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "args": vars(args),
+        },
+        "summary": summary,
+    }
+
+    output = args.output or os.path.join(
+        BENCH_DIR, f"{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')}_{report['meta']['commit']}_{args.target}.json"
+    )
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    print(json.dumps(report["summary"], indent=2))
+    print(f"📄 Wrote {output}")
+
+
+if __name__ == "__main__":
+    main()
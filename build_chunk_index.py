@@ -0,0 +1,28 @@
+import sys
+from schema_utils import load_schema_chunks, list_databases
+from description_utils import load_descriptions, enrich_schema_with_descriptions
+from vector_store import build_chunk_index
+
+SPIDER_PATH = "spider/database"
+
+def build_all(db_ids=None, force=False):
+    descriptions = load_descriptions()
+    db_ids = db_ids or list_databases()
+    rebuilt = 0
+
+    for db_id in db_ids:
+        db_path = f"{SPIDER_PATH}/{db_id}/{db_id}.sqlite"
+        try:
+            schema_chunks = load_schema_chunks(db_id, db_path)
+            enriched_chunks = enrich_schema_with_descriptions(schema_chunks, db_id, descriptions)
+            if build_chunk_index(f"schema_chunks_{db_id}", enriched_chunks, force=force):
+                rebuilt += 1
+                print(f"✅ Indexed {db_id} ({len(enriched_chunks)} chunks)")
+        except Exception as e:
+            print(f"❌ Failed to index {db_id}: {e}")
+
+    print(f"📦 {rebuilt} rebuilt, {len(db_ids) - rebuilt} up to date or skipped")
+
+if __name__ == "__main__":
+    args = [a for a in sys.argv[1:] if a != "--force"]
+    build_all(args or None, force="--force" in sys.argv)
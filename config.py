@@ -1,6 +1,28 @@
 # config.py
+import os
 
 # OpenAI API Key (replace this with your actual key or load from env vars)
-OPENAI_API_KEY = ""
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
 
+# generate_sql_multi fan-out: parallel databases per request and per-DB deadline (seconds)
+FANOUT_CONCURRENCY = int(os.getenv("FANOUT_CONCURRENCY", "4"))
+FANOUT_DB_TIMEOUT = float(os.getenv("FANOUT_DB_TIMEOUT", "30"))
 
+# LLM client: optional base URL (e.g. a local fake server), connection pool, rate limits and retries
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL") or None
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "50"))
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "60"))
+LLM_REQUESTS_PER_MINUTE = float(os.getenv("LLM_REQUESTS_PER_MINUTE", "3500"))
+LLM_TOKENS_PER_MINUTE = float(os.getenv("LLM_TOKENS_PER_MINUTE", "90000"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "5"))
+
+# Conditional routing in build_graph: skip LLM steps whose outcome is already decided.
+# A top-1 routing-matrix score at least ROUTE_MIN_SCORE and ROUTE_MARGIN ahead of the runner-up
+# sends the question to that single DB without asking GPT to pick databases.
+CONDITIONAL_ROUTING = os.getenv("CONDITIONAL_ROUTING", "1") == "1"
+ROUTE_MARGIN = float(os.getenv("ROUTE_MARGIN", "0.15"))
+ROUTE_MIN_SCORE = float(os.getenv("ROUTE_MIN_SCORE", "0.35"))
+
+# /query/batch: unique questions run through the graph at once, and the largest accepted batch
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "1000"))
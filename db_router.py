@@ -0,0 +1,139 @@
+import hashlib
+import json
+import os
+import threading
+import numpy as np
+
+EMBEDDING_DIR = "schema_embeddings"
+MATRIX_FILE = "db_matrix.npy"
+INDEX_FILE = "db_index.json"
+DESCRIPTION_MATRIX_FILE = "description_matrix.npy"
+DESCRIPTION_INDEX_FILE = "description_index.json"
+
+# (mtime_ns, matrix, db_ids) for the currently mapped matrix
+_mapped = None
+# (descriptions object, matrix, db_ids) for the current descriptions
+_description_cache = None
+_lock = threading.Lock()
+
+
+def _normalize(matrix):
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.clip(norms, 1e-12, None)
+
+
+def _atomic_save_npy(path, array):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+
+
+def _atomic_save_json(path, data):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def save_db_matrix(embeddings, embedding_dir=EMBEDDING_DIR):
+    # embeddings: {db_id: 1-D vector}; written as one contiguous, L2-normalized float32 matrix
+    os.makedirs(embedding_dir, exist_ok=True)
+    db_ids = sorted(embeddings)
+    matrix = np.stack([np.asarray(embeddings[db_id], dtype=np.float32).ravel() for db_id in db_ids])
+    matrix = np.ascontiguousarray(_normalize(matrix), dtype=np.float32)
+
+    # Index first, matrix last: readers key their reload on the matrix mtime
+    _atomic_save_json(os.path.join(embedding_dir, INDEX_FILE), db_ids)
+    _atomic_save_npy(os.path.join(embedding_dir, MATRIX_FILE), matrix)
+    return matrix, db_ids
+
+
+def load_db_matrix(embedding_dir=EMBEDDING_DIR):
+    # Memory-mapped read-only, so forked/parallel workers share the same page cache
+    global _mapped
+    matrix_path = os.path.join(embedding_dir, MATRIX_FILE)
+    mtime = os.stat(matrix_path).st_mtime_ns
+
+    with _lock:
+        if _mapped and _mapped[0] == mtime:
+            return _mapped[1], _mapped[2]
+
+        matrix = np.load(matrix_path, mmap_mode="r")
+        with open(os.path.join(embedding_dir, INDEX_FILE), "r") as f:
+            db_ids = json.load(f)
+        if len(db_ids) != matrix.shape[0]:
+            raise ValueError(f"{INDEX_FILE} lists {len(db_ids)} databases but {MATRIX_FILE} has {matrix.shape[0]} rows")
+
+        _mapped = (mtime, matrix, db_ids)
+        return matrix, db_ids
+
+
+def top_k_scores(matrix, query_embedding, k):
+    # One matrix-vector product + argpartition; returns (row indices, scores) best first
+    query = _normalize(np.asarray(query_embedding, dtype=np.float32).ravel())
+    scores = matrix @ query
+    k = min(k, scores.shape[0])
+    if k <= 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    if k < scores.shape[0]:
+        idx = np.argpartition(-scores, k - 1)[:k]
+    else:
+        idx = np.arange(scores.shape[0])
+    idx = idx[np.argsort(-scores[idx])]
+    return idx, scores[idx]
+
+
+def top_k_databases(query_embedding, k=3, embedding_dir=EMBEDDING_DIR):
+    matrix, db_ids = load_db_matrix(embedding_dir)
+    idx, scores = top_k_scores(matrix, query_embedding, k)
+    return [(float(score), db_ids[i]) for i, score in zip(idx, scores)]
+
+
+def descriptions_hash(descriptions, model_name):
+    h = hashlib.sha256(model_name.encode())
+    for db_id in sorted(descriptions):
+        h.update(db_id.encode())
+        h.update(b"\0")
+        h.update(descriptions[db_id].get("description", "").encode())
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def load_description_matrix(descriptions, encode, model_name, embedding_dir=EMBEDDING_DIR):
+    # encode: list[str] -> 2-D array. Called once, batched, only when the cached hash is stale.
+    global _description_cache
+    with _lock:
+        if _description_cache and _description_cache[0] is descriptions:
+            return _description_cache[1], _description_cache[2]
+
+    content_hash = descriptions_hash(descriptions, model_name)
+    matrix_path = os.path.join(embedding_dir, DESCRIPTION_MATRIX_FILE)
+    index_path = os.path.join(embedding_dir, DESCRIPTION_INDEX_FILE)
+
+    matrix = None
+    try:
+        with open(index_path, "r") as f:
+            index = json.load(f)
+        if index.get("content_hash") == content_hash and index.get("model") == model_name:
+            db_ids = index["db_ids"]
+            matrix = np.load(matrix_path, mmap_mode="r")
+            # A matrix from another model (or a hand-made one) must not be scored against the question
+            if matrix.ndim != 2 or matrix.shape != (len(db_ids), index.get("dimension")):
+                print(f"⚠️ Cached description matrix {matrix.shape} doesn't match its index, rebuilding")
+                matrix = None
+    except (OSError, ValueError, KeyError):
+        matrix = None
+
+    if matrix is None:
+        db_ids = sorted(descriptions)
+        texts = [descriptions[db_id].get("description", "") for db_id in db_ids]
+        print(f"🔄 Encoding {len(texts)} database descriptions")
+        matrix = np.ascontiguousarray(_normalize(np.asarray(encode(texts), dtype=np.float32)))
+        os.makedirs(embedding_dir, exist_ok=True)
+        _atomic_save_npy(matrix_path, matrix)
+        _atomic_save_json(index_path, {"content_hash": content_hash, "model": model_name, "dimension": int(matrix.shape[1]), "db_ids": db_ids})
+
+    with _lock:
+        _description_cache = (descriptions, matrix, db_ids)
+    return matrix, db_ids
@@ -1,14 +1,16 @@
-import json
+from schema_catalog import DESCRIPTIONS_PATH, get_descriptions
 
-def load_descriptions(path="descriptions.json"):
-    with open(path, "r") as f:
-        return json.load(f)
+def load_descriptions(path=DESCRIPTIONS_PATH):
+    # Served from the process-wide catalog; re-read only when the file changes
+    return get_descriptions(path)
 
-def enrich_schema_with_descriptions(schema_chunks, db_id, descriptions):
+def enrich_schema_with_descriptions(schema_chunks, db_id, descriptions=None):
     enriched = []
+    if descriptions is None:
+        descriptions = get_descriptions()
     db_info = descriptions.get(db_id, {})
     table_descs = db_info.get("tables", {})
-    
+
     for chunk in schema_chunks:
         if "Table:" in chunk:
             lines = chunk.strip().split("\n")
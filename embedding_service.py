@@ -0,0 +1,173 @@
+import asyncio
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from functools import lru_cache
+import numpy as np
+from metrics import span
+
+EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+MAX_BATCH_SIZE = int(os.getenv("EMBED_MAX_BATCH_SIZE", "64"))
+MAX_WAIT_MS = float(os.getenv("EMBED_MAX_WAIT_MS", "5"))
+QUESTION_CACHE_SIZE = int(os.getenv("QUESTION_CACHE_SIZE", "1024"))
+
+
+class EmbeddingService:
+    # One model per process. Concurrent encode() callers are queued and served
+    # by a single worker thread that merges their texts into micro-batches,
+    # waiting at most MAX_WAIT_MS for more work after the first request arrives.
+
+    def __init__(self, model_name=EMBEDDING_MODEL, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS):
+        self.model_name = model_name
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self._model = None
+        self._queue = queue.Queue()
+        self._worker = None
+        self._lock = threading.Lock()
+        self._stats = {
+            "requests": 0,
+            "texts": 0,
+            "batches": 0,
+            "max_batch_size": 0,
+            "queue_wait_seconds_total": 0.0,
+            "queue_wait_seconds_max": 0.0,
+            "encode_seconds_total": 0.0,
+        }
+
+    @property
+    def model(self):
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    from sentence_transformers import SentenceTransformer
+                    self._model = SentenceTransformer(self.model_name)
+        return self._model
+
+    def _ensure_worker(self):
+        if self._worker is None or not self._worker.is_alive():
+            with self._lock:
+                if self._worker is None or not self._worker.is_alive():
+                    self._worker = threading.Thread(target=self._run, name="embedding-service", daemon=True)
+                    self._worker.start()
+
+    def submit(self, texts, normalize=False):
+        single = isinstance(texts, str)
+        texts = [texts] if single else list(texts)
+        future = Future()
+        if not texts:
+            future.set_result(np.empty((0, 0), dtype=np.float32))
+            return future
+
+        self._ensure_worker()
+        self._queue.put((texts, single, normalize, time.perf_counter(), future))
+        return future
+
+    def encode(self, texts, normalize=False):
+        # str -> 1-D vector, list[str] -> 2-D matrix (float32 numpy)
+        with span("embedding", "encode", texts=1 if isinstance(texts, str) else len(texts)):
+            return self.submit(texts, normalize).result()
+
+    async def aencode(self, texts, normalize=False):
+        with span("embedding", "encode", texts=1 if isinstance(texts, str) else len(texts)):
+            return await asyncio.wrap_future(self.submit(texts, normalize))
+
+    def _collect_batch(self):
+        # Requests cancelled while queued (e.g. a dropped aencode caller) are skipped;
+        # the rest are marked running so they can no longer be cancelled under us
+        item = self._queue.get()
+        while not item[4].set_running_or_notify_cancel():
+            item = self._queue.get()
+        batch = [item]
+        size = len(item[0])
+        deadline = time.perf_counter() + self.max_wait
+
+        while size < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if not item[4].set_running_or_notify_cancel():
+                continue
+            batch.append(item)
+            size += len(item[0])
+        return batch
+
+    def _run(self):
+        # The only worker: nothing a batch raises may end this loop
+        while True:
+            batch = []
+            try:
+                batch = self._collect_batch()
+                self._encode_batch(batch)
+            except Exception as e:
+                print(f"⚠️ Embedding batch failed: {e}")
+                for item in batch:
+                    if not item[4].done():
+                        item[4].set_exception(e)
+
+    def _encode_batch(self, batch):
+        started = time.perf_counter()
+        texts = [text for item in batch for text in item[0]]
+        embeddings = np.asarray(
+            self.model.encode(texts, batch_size=self.max_batch_size, show_progress_bar=False),
+            dtype=np.float32,
+        )
+        self._record(batch, len(texts), started)
+
+        offset = 0
+        for item_texts, single, normalize, _, future in batch:
+            result = embeddings[offset:offset + len(item_texts)]
+            offset += len(item_texts)
+            if normalize:
+                result = result / np.clip(np.linalg.norm(result, axis=1, keepdims=True), 1e-12, None)
+            if not future.done():
+                future.set_result(result[0] if single else result)
+
+    def _record(self, batch, num_texts, started):
+        waits = [started - item[3] for item in batch]
+        with self._lock:
+            stats = self._stats
+            stats["requests"] += len(batch)
+            stats["texts"] += num_texts
+            stats["batches"] += 1
+            stats["max_batch_size"] = max(stats["max_batch_size"], num_texts)
+            stats["queue_wait_seconds_total"] += sum(waits)
+            stats["queue_wait_seconds_max"] = max(stats["queue_wait_seconds_max"], max(waits))
+            stats["encode_seconds_total"] += time.perf_counter() - started
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        batches = stats["batches"] or 1
+        requests = stats["requests"] or 1
+        stats["mean_batch_size"] = stats["texts"] / batches
+        stats["mean_queue_wait_seconds"] = stats["queue_wait_seconds_total"] / requests
+        stats["queue_depth"] = self._queue.qsize()
+        return stats
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def get_embedding_service():
+    global _service
+    if _service is None:
+        with _service_lock:
+            if _service is None:
+                _service = EmbeddingService()
+    return _service
+
+
+@lru_cache(maxsize=QUESTION_CACHE_SIZE)
+def encode_question(question):
+    # L2-normalized and read-only, so every consumer can share the cached array
+    embedding = get_embedding_service().encode(question, normalize=True)
+    embedding.setflags(write=False)
+    return embedding
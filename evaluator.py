@@ -1,5 +1,29 @@
+import argparse
+import csv
+import hashlib
+import json
+import multiprocessing
+import os
+import pickle
+import re
+import sqlite3
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
 import sqlparse
 
+SPIDER_PATH = "spider/database"
+GOLD_CACHE_PATH = os.getenv("GOLD_CACHE_PATH", "gold_cache.sqlite")
+EVAL_WORKERS = int(os.getenv("EVAL_WORKERS", str(os.cpu_count() or 4)))
+EVAL_TIMEOUT = float(os.getenv("EVAL_TIMEOUT", "30"))
+EVAL_MAX_ROWS = int(os.getenv("EVAL_MAX_ROWS", "100000"))
+EVAL_CHUNK_SIZE = 256  # (pred, gold) pairs per worker task
+
+FAILED_SQL = "SQL generation failed"
+_ORDER_BY = re.compile(r"\border\s+by\b", re.IGNORECASE)
+
+
 def evaluate_sql_outputs(question, gpt_output, gold=None, verbose=False):
     if not verbose:
         return
@@ -14,3 +38,236 @@ def evaluate_sql_outputs(question, gpt_output, gold=None, verbose=False):
         print("Gold SQL:")
         print(sqlparse.format(gold, reindent=True))
     print("="*50 + "\n")
+
+
+def _db_path(db_id, spider_path=SPIDER_PATH):
+    return os.path.join(spider_path, db_id, f"{db_id}.sqlite")
+
+
+def _normalize(rows):
+    # Floats are rounded so 1/3 computed two ways still compares equal
+    return [tuple(round(v, 6) if isinstance(v, float) else v for v in row) for row in rows]
+
+
+def results_match(pred_rows, gold_rows, gold_sql):
+    # Order only matters when the gold query asks for it
+    if _ORDER_BY.search(gold_sql):
+        return pred_rows == gold_rows
+    return Counter(pred_rows) == Counter(gold_rows)
+
+
+def _run(db_path, sql, timeout, max_rows):
+    # Returns (rows, error); rows are normalized
+    import sqlite_pool
+    try:
+        rows, truncated = sqlite_pool.execute(db_path, sql, timeout=timeout, max_rows=max_rows)
+    except sqlite_pool.QueryTimeout:
+        return None, "timeout"
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"
+    if truncated:
+        return None, f"more than {max_rows} rows"
+    return _normalize(rows), None
+
+
+def _evaluate_chunk(db_path, pairs, cached_gold, timeout, max_rows):
+    # Worker: pairs is [(pred, gold)]; returns per-pair outcomes plus newly computed gold results
+    gold_results = dict(cached_gold)
+    new_gold = {}
+    outcomes = []
+    for pred, gold in pairs:
+        if gold not in gold_results:
+            gold_results[gold] = new_gold[gold] = _run(db_path, gold, timeout, max_rows)
+        gold_rows, gold_error = gold_results[gold]
+
+        if not pred or pred == FAILED_SQL:
+            outcomes.append((False, "no prediction"))
+            continue
+        if gold_error:
+            outcomes.append((False, f"gold: {gold_error}"))
+            continue
+        pred_rows, pred_error = _run(db_path, pred, timeout, max_rows)
+        if pred_error:
+            outcomes.append((False, pred_error))
+            continue
+        outcomes.append((results_match(pred_rows, gold_rows, gold), None))
+    return outcomes, new_gold
+
+
+class GoldCache:
+    # Gold results on disk, keyed by db file mtime so a rebuilt database is re-executed
+
+    def __init__(self, path=GOLD_CACHE_PATH):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS gold (
+                key TEXT PRIMARY KEY,
+                rows BLOB,
+                error TEXT
+            )
+        """)
+
+    @staticmethod
+    def key(db_path, sql):
+        mtime = os.path.getmtime(db_path) if os.path.exists(db_path) else 0
+        return hashlib.sha256(f"{db_path}\0{mtime}\0{sql}".encode()).hexdigest()
+
+    def get_many(self, db_path, sqls):
+        found = {}
+        keys = {self.key(db_path, sql): sql for sql in sqls}
+        items = list(keys.items())
+        for i in range(0, len(items), 500):
+            batch = [k for k, _ in items[i:i + 500]]
+            cursor = self.conn.execute(
+                f"SELECT key, rows, error FROM gold WHERE key IN ({','.join('?' * len(batch))})", batch
+            )
+            for key, rows, error in cursor:
+                found[keys[key]] = (pickle.loads(rows) if rows is not None else None, error)
+        return found
+
+    def set_many(self, db_path, results):
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO gold (key, rows, error) VALUES (?, ?, ?)",
+            [
+                (self.key(db_path, sql), pickle.dumps(rows) if rows is not None else None, error)
+                for sql, (rows, error) in results.items()
+                # Timeouts may be transient; don't pin them
+                if error != "timeout"
+            ],
+        )
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+def evaluate(records, workers=EVAL_WORKERS, timeout=EVAL_TIMEOUT, max_rows=EVAL_MAX_ROWS,
+             spider_path=SPIDER_PATH, cache_path=GOLD_CACHE_PATH):
+    # records: dicts with db_id, question, pred, gold. Returns the records with "correct" and "error" set.
+    # Identical (db_id, pred, gold) triples are executed once.
+    unique = defaultdict(dict)  # db_id -> {(pred, gold): outcome}
+    for record in records:
+        unique[record["db_id"]].setdefault((record.get("pred") or "", record["gold"]), None)
+
+    cache = GoldCache(cache_path) if cache_path else None
+    started = time.perf_counter()
+    total = sum(len(pairs) for pairs in unique.values())
+    done = 0
+
+    # spawn: children must not inherit pooled SQLite connections from the parent
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        futures = {}
+        for db_id, pairs in unique.items():
+            db_path = _db_path(db_id, spider_path)
+            keys = list(pairs)
+            cached = cache.get_many(db_path, {gold for _, gold in keys}) if cache else {}
+            for i in range(0, len(keys), EVAL_CHUNK_SIZE):
+                chunk = keys[i:i + EVAL_CHUNK_SIZE]
+                chunk_gold = {gold: cached[gold] for _, gold in chunk if gold in cached}
+                future = executor.submit(_evaluate_chunk, db_path, chunk, chunk_gold, timeout, max_rows)
+                futures[future] = (db_id, db_path, chunk)
+
+        for future in as_completed(futures):
+            db_id, db_path, chunk = futures[future]
+            try:
+                outcomes, new_gold = future.result()
+            except Exception as e:
+                outcomes, new_gold = [(False, f"worker failed: {e}")] * len(chunk), {}
+            for key, outcome in zip(chunk, outcomes):
+                unique[db_id][key] = outcome
+            if cache and new_gold:
+                cache.set_many(db_path, new_gold)
+            done += len(chunk)
+            print(f"⏱️ {done}/{total} unique pairs scored ({time.perf_counter() - started:.1f}s)")
+
+    if cache:
+        cache.close()
+
+    for record in records:
+        record["correct"], record["error"] = unique[record["db_id"]][(record.get("pred") or "", record["gold"])]
+    return records
+
+
+def execution_accuracy(records):
+    def summary(items):
+        correct = sum(1 for r in items if r["correct"])
+        return {
+            "count": len(items),
+            "correct": correct,
+            "accuracy": round(correct / len(items), 4) if items else 0.0,
+            "no_prediction": sum(1 for r in items if r["error"] == "no prediction"),
+            "timeouts": sum(1 for r in items if r["error"] == "timeout"),
+            "errors": sum(1 for r in items if r["error"] not in (None, "no prediction", "timeout")),
+        }
+
+    by_db = defaultdict(list)
+    for record in records:
+        by_db[record["db_id"]].append(record)
+    return {
+        "overall": summary(records),
+        "per_db": {db_id: summary(items) for db_id, items in sorted(by_db.items())},
+    }
+
+
+def load_gold(paths):
+    # Spider-style JSON files -> {(db_id, question): gold SQL}
+    gold = {}
+    for path in paths:
+        with open(path) as f:
+            for example in json.load(f):
+                gold[(example["db_id"], example["question"].strip())] = example["query"]
+    return gold
+
+
+def load_log_records(path, gold):
+    # Joins logged predictions (CSV log or SQLite archive) with gold SQL; rows without gold are skipped
+    if path.endswith(".sqlite"):
+        conn = sqlite3.connect(path)
+        rows = conn.execute("SELECT db_id, question, gpt_sql FROM results")
+    else:
+        csv.field_size_limit(1 << 30)
+        f = open(path, newline="")
+        rows = ((r["db_id"], r["question"], r["gpt_sql"]) for r in csv.DictReader(f))
+
+    records = []
+    try:
+        for db_id, question, pred in rows:
+            gold_sql = gold.get((db_id, (question or "").strip()))
+            if gold_sql is not None:
+                records.append({"db_id": db_id, "question": question, "pred": pred, "gold": gold_sql})
+    finally:
+        (conn if path.endswith(".sqlite") else f).close()
+    return records
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Execution accuracy of logged SQL against Spider gold queries")
+    parser.add_argument("--log", default="results.csv", help="results.csv, results_log.csv, a JSONL of records, or the SQLite archive")
+    parser.add_argument("--gold", nargs="+", default=["spider/dev.json"])
+    parser.add_argument("--workers", type=int, default=EVAL_WORKERS)
+    parser.add_argument("--timeout", type=float, default=EVAL_TIMEOUT)
+    parser.add_argument("--no-cache", action="store_true")
+    parser.add_argument("--output", default="eval_report.json")
+    args = parser.parse_args()
+
+    if args.log.endswith(".jsonl"):
+        with open(args.log) as f:
+            records = [json.loads(line) for line in f if line.strip()]
+    else:
+        records = load_log_records(args.log, load_gold(args.gold))
+    print(f"📋 {len(records)} records with gold SQL")
+
+    started = time.perf_counter()
+    evaluate(records, workers=args.workers, timeout=args.timeout, cache_path=None if args.no_cache else GOLD_CACHE_PATH)
+    report = execution_accuracy(records)
+    report["elapsed_seconds"] = round(time.perf_counter() - started, 2)
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    overall = report["overall"]
+    print(f"✅ Execution accuracy: {overall['accuracy']:.2%} ({overall['correct']}/{overall['count']}) in {report['elapsed_seconds']}s")
+    print(f"📄 Wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
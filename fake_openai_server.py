@@ -0,0 +1,152 @@
+# Minimal stand-in for the OpenAI chat completions API, for local load and retry testing.
+#   uvicorn fake_openai_server:app --port 8001
+#   OPENAI_BASE_URL=http://localhost:8001/v1 uvicorn api:app
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+import time
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# Latency spec: "fixed:MS", "uniform:LO:HI", "normal:MEAN:STD", "lognormal:MEDIAN_MS:SIGMA"
+LATENCY = os.getenv("FAKE_OPENAI_LATENCY", f"fixed:{os.getenv('FAKE_OPENAI_LATENCY_MS', '200')}")
+ERROR_RATE = float(os.getenv("FAKE_OPENAI_ERROR_RATE", "0"))
+SEED = int(os.getenv("FAKE_OPENAI_SEED", "0"))
+# Streaming responses: the latency above is time to first token, then this much per token
+TOKEN_MS = float(os.getenv("FAKE_OPENAI_TOKEN_MS", "10"))
+
+app = FastAPI()
+stats = {"requests": 0, "errors": 0}
+
+
+def parse_latency(spec):
+    kind, *params = spec.split(":")
+    params = [float(p) for p in params]
+    samplers = {
+        "fixed": lambda rng: params[0],
+        "uniform": lambda rng: rng.uniform(params[0], params[1]),
+        "normal": lambda rng: max(0.0, rng.gauss(params[0], params[1])),
+        "lognormal": lambda rng: params[0] * rng.lognormvariate(0.0, params[1]),
+    }
+    if kind not in samplers:
+        raise ValueError(f"Unknown latency distribution: {spec}")
+    return samplers[kind]
+
+
+_sample_latency = parse_latency(LATENCY)
+
+
+def configure(latency=None, error_rate=None, seed=None):
+    global _sample_latency, LATENCY, ERROR_RATE, SEED
+    if latency is not None:
+        LATENCY = latency
+        _sample_latency = parse_latency(latency)
+    if error_rate is not None:
+        ERROR_RATE = error_rate
+    if seed is not None:
+        SEED = seed
+
+
+_occurrences = {}
+
+
+def _rng_for(prompt):
+    # Seeded by the prompt and how often it was seen, so a replayed workload sees the
+    # same latencies and errors while a retried prompt still gets a fresh draw
+    key = hashlib.sha256(prompt.encode()).hexdigest()
+    nth = _occurrences[key] = _occurrences.get(key, 0) + 1
+    digest = hashlib.sha256(f"{SEED}\0{key}\0{nth}".encode()).digest()
+    return random.Random(int.from_bytes(digest[:8], "big"))
+
+
+def fake_completion(prompt):
+    # Deterministic answers shaped like what each prompt in the pipeline expects
+    if '"hinted_db"' in prompt:
+        return json.dumps({"hinted_db": None, "hinted_column": None})
+
+    if "Return a JSON list" in prompt:
+        candidates = re.findall(r"^- ([\w\-]+):", prompt, re.MULTILINE)
+        return json.dumps(candidates[:2])
+
+    if "Pick the best database name key" in prompt:
+        keys = re.findall(r'^\s*"([\w\-]+)": ', prompt, re.MULTILINE)
+        return keys[0] if keys else "unknown"
+
+    if prompt.rstrip().endswith("SQL:"):
+        tables = re.findall(r"Table: (\w+)", prompt)
+        table = tables[0] if tables else "sqlite_master"
+        return f"```sql\nSELECT COUNT(*) FROM {table};\n```"
+
+    match = re.search(r'Database result:\s*"""(.*?)"""', prompt, re.DOTALL)
+    return match.group(1).strip() if match else "OK"
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    prompt = "\n".join(m.get("content", "") for m in body.get("messages", []))
+    rng = _rng_for(prompt)
+    stats["requests"] += 1
+    await asyncio.sleep(_sample_latency(rng) / 1000.0)
+
+    if ERROR_RATE and rng.random() < ERROR_RATE:
+        stats["errors"] += 1
+        return JSONResponse(
+            {"error": {"message": "Rate limit reached (fake)", "type": "rate_limit_error"}},
+            status_code=429,
+            headers={"retry-after": "0.1"},
+        )
+
+    content = fake_completion(prompt)
+    prompt_tokens = len(prompt) // 4
+    completion_tokens = max(1, len(content) // 4)
+    usage = {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+    }
+
+    if body.get("stream"):
+        include_usage = (body.get("stream_options") or {}).get("include_usage", False)
+        return StreamingResponse(_stream(content, body.get("model", "gpt-3.5-turbo"), usage if include_usage else None),
+                                 media_type="text/event-stream")
+
+    return {
+        "id": f"chatcmpl-fake-{int(time.time() * 1000)}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "gpt-3.5-turbo"),
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": content},
+            "finish_reason": "stop",
+        }],
+        "usage": usage,
+    }
+
+
+async def _stream(content, model, usage):
+    chunk_id = f"chatcmpl-fake-{int(time.time() * 1000)}"
+
+    def event(delta, finish_reason=None, chunk_usage=None):
+        choices = [] if delta is None else [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+        payload = {"id": chunk_id, "object": "chat.completion.chunk", "created": int(time.time()),
+                   "model": model, "choices": choices, "usage": chunk_usage}
+        return f"data: {json.dumps(payload)}\n\n"
+
+    yield event({"role": "assistant", "content": ""})
+    for piece in re.findall(r"\S+\s*|\s+", content):
+        yield event({"content": piece})
+        await asyncio.sleep(TOKEN_MS / 1000.0)
+    yield event({}, finish_reason="stop")
+    if usage is not None:
+        yield event(None, chunk_usage=usage)
+    yield "data: [DONE]\n\n"
+
+
+@app.get("/stats")
+def server_stats():
+    return {**stats, "latency": LATENCY, "error_rate": ERROR_RATE, "seed": SEED}
@@ -0,0 +1,181 @@
+import os
+import re
+import threading
+from difflib import get_close_matches
+from functools import lru_cache
+from schema_catalog import TABLES_PATH, DESCRIPTIONS_PATH, get_schema_index, get_descriptions
+
+MAX_NGRAM = 4
+# Several DBs fully named in the question count as one hint only when the winner's
+# table/column evidence leads by this much; otherwise the GPT extractor decides
+HINT_MARGIN = float(os.getenv("HINT_MARGIN", "0.5"))
+HINT_COLUMN_MIN_SCORE = float(os.getenv("HINT_COLUMN_MIN_SCORE", "0.5"))
+
+# Evidence weights per n-gram token, divided by the number of DBs sharing the phrase
+KIND_WEIGHTS = {"table": 1.0, "column": 0.5, "description": 0.2}
+
+STOPWORDS = {
+    "a", "an", "the", "of", "in", "on", "for", "to", "and", "or", "by", "with", "from", "at", "is", "are",
+    "was", "were", "be", "what", "which", "who", "whom", "how", "many", "much", "list", "show", "give",
+    "find", "return", "all", "each", "every", "that", "this", "these", "those", "their", "its", "there",
+    "than", "more", "most", "least", "number", "count", "me", "do", "doe", "did", "have", "ha", "it",
+    "database", "db", "table", "column", "id",
+}
+# A one-word DB name ("pets", "world") only counts as a mention next to one of these
+DB_WORDS = {"database", "db", "schema", "dataset"}
+
+_TOKEN = re.compile(r"[a-z0-9]+")
+_CAMEL = re.compile(r"(?<=[a-z0-9])(?=[A-Z])")
+
+# (schema index, descriptions, built index) for the current catalog objects
+_index = None
+_lock = threading.Lock()
+
+
+def _stem(token):
+    if len(token) > 4 and token.endswith("ies"):
+        return token[:-3] + "y"
+    if len(token) > 3 and token.endswith("s") and not token.endswith("ss"):
+        return token[:-1]
+    return token
+
+
+def normalize(text):
+    # "concertSinger_IDs" -> ("concert", "singer", "id")
+    text = _CAMEL.sub(" ", text).replace("_", " ").lower()
+    return tuple(_stem(token) for token in _TOKEN.findall(text))
+
+
+def _ngrams(tokens, max_n=MAX_NGRAM):
+    for n in range(1, max_n + 1):
+        for i in range(len(tokens) - n + 1):
+            gram = tokens[i:i + n]
+            if n == 1 and (gram[0] in STOPWORDS or gram[0].isdigit()):
+                continue
+            yield gram
+
+
+def _build(schema_index, descriptions):
+    db_names = {}       # phrase -> {db_id}; the db_id with and without its numeric suffix
+    name_lengths = {}   # db_id -> tokens in its shortest alias
+    schema = {}         # phrase -> {db_id: [(kind, table, column)]}
+
+    def add(phrase, db_id, entry):
+        if phrase and not (len(phrase) == 1 and phrase[0] in STOPWORDS):
+            schema.setdefault(phrase, {}).setdefault(db_id, []).append(entry)
+
+    for db_id, db_schema in schema_index.items():
+        full = normalize(db_id)
+        short = tuple(token for token in full if not token.isdigit()) or full
+        for alias in {full, short}:
+            db_names.setdefault(alias, set()).add(db_id)
+        name_lengths[db_id] = len(short)
+
+        for table, columns in db_schema["columns"].items():
+            add(normalize(table), db_id, ("table", table, None))
+            for column in columns:
+                add(normalize(column), db_id, ("column", table, column))
+
+        # Content words of the descriptions act as weak synonyms ("professors" -> academic)
+        described = descriptions.get(db_id, {})
+        texts = [described.get("description", "")] + list(described.get("tables", {}).values())
+        for token in {token for text in texts for token in normalize(text)}:
+            add((token,), db_id, ("description", None, None))
+
+    return {"db_names": db_names, "name_lengths": name_lengths, "schema": schema, "db_ids": sorted(schema_index)}
+
+
+def get_hint_index(tables_path=TABLES_PATH, descriptions_path=DESCRIPTIONS_PATH):
+    # Rebuilt only when the catalog hands back new objects (i.e. a source file changed)
+    global _index
+    schema_index = get_schema_index(tables_path)
+    try:
+        descriptions = get_descriptions(descriptions_path)
+    except OSError:
+        descriptions = {}
+
+    with _lock:
+        if _index and _index[0] is schema_index and _index[1] is descriptions:
+            return _index[2]
+
+    built = _build(schema_index, descriptions)
+    with _lock:
+        _index = (schema_index, descriptions, built)
+    resolve_db_name.cache_clear()
+    return built
+
+
+def extract_hints(question, index=None):
+    # Returns hinted_db / hinted_column with scores; ambiguous=True means the caller should ask GPT
+    index = index or get_hint_index()
+    tokens = normalize(question)
+    grams = set(_ngrams(tokens))
+    says_database = not DB_WORDS.isdisjoint(tokens)
+
+    coverage = {}
+    evidence = {}
+    columns = []
+    for gram in grams:
+        for db_id in index["db_names"].get(gram, ()):
+            value = min(1.0, len(gram) / max(index["name_lengths"][db_id], 1))
+            if len(gram) == 1 and not says_database:
+                value = min(value, 0.5)
+            coverage[db_id] = max(coverage.get(db_id, 0.0), value)
+        hits = index["schema"].get(gram)
+        if not hits:
+            continue
+        for db_id, entries in hits.items():
+            kinds = {kind for kind, _, _ in entries}
+            evidence[db_id] = evidence.get(db_id, 0.0) + len(gram) * max(KIND_WEIGHTS[k] for k in kinds) / len(hits)
+            columns.extend((gram, db_id, table, column, len(hits)) for kind, table, column in entries if kind == "column")
+
+    named = sorted(
+        (db_id for db_id, value in coverage.items() if value >= 1.0),
+        key=lambda db_id: -evidence.get(db_id, 0.0),
+    )
+    hinted_db, db_score, ambiguous = None, max(coverage.values(), default=0.0), False
+    if len(named) == 1:
+        hinted_db = named[0]
+    elif len(named) > 1:
+        lead = evidence.get(named[0], 0.0) - evidence.get(named[1], 0.0)
+        if lead >= HINT_MARGIN:
+            hinted_db = named[0]
+        else:
+            ambiguous = True
+
+    hinted_column, column_score = None, 0.0
+    for gram, db_id, table, column, shared in columns:
+        if hinted_db and db_id != hinted_db:
+            continue
+        # Full-name matches score 1.0 inside the hinted DB; generic names shared by many DBs fade out
+        score = len(gram) / len(normalize(column)) / (1 if hinted_db else shared)
+        if score > column_score or (score == column_score and hinted_column and len(column) > len(hinted_column)):
+            hinted_column, column_score = column, score
+    if column_score < HINT_COLUMN_MIN_SCORE:
+        hinted_column = None
+
+    ranked = sorted(evidence.items(), key=lambda item: -item[1])[:5]
+    return {
+        "hinted_db": hinted_db,
+        "hinted_column": hinted_column,
+        "db_score": round(db_score, 3),
+        "column_score": round(column_score, 3),
+        "ambiguous": ambiguous,
+        "named_dbs": named,
+        "candidates": [[db_id, round(score, 3)] for db_id, score in ranked],
+    }
+
+
+@lru_cache(maxsize=4096)
+def resolve_db_name(name, available=None):
+    # Exact id, then normalized alias, then difflib over the cached id list.
+    # available (a frozenset of db_ids) limits the answer to databases that actually exist.
+    index = _index[2] if _index else get_hint_index()
+    db_ids = index["db_ids"] if available is None else [db_id for db_id in index["db_ids"] if db_id in available]
+    if name in index["name_lengths"] and (available is None or name in available):
+        return name
+    aliases = [db_id for db_id in index["db_names"].get(normalize(name), ()) if available is None or db_id in available]
+    if len(aliases) == 1:
+        return aliases[0]
+    matches = get_close_matches(name.lower(), db_ids, n=1, cutoff=0.6)
+    return matches[0] if matches else None
@@ -1,19 +1,28 @@
 from langgraph.graph import StateGraph
 from typing import TypedDict
-from sentence_transformers import SentenceTransformer, util
+from embedding_service import EMBEDDING_MODEL, get_embedding_service, encode_question
 from langchain_core.runnables import RunnableLambda
-import torch
+from langgraph.config import get_config, get_stream_writer
 import os
+import re
+import asyncio
+import math
+import time
 import io
 import sys
 import json
 from difflib import get_close_matches
-from schema_utils import list_databases
-from schema_utils import list_databases
-from main import run_query
-from model_runner import run_gpt35
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from config import FANOUT_CONCURRENCY, FANOUT_DB_TIMEOUT, CONDITIONAL_ROUTING, ROUTE_MARGIN, ROUTE_MIN_SCORE
+from schema_utils import SPIDER_PATH, list_databases
+from db_router import top_k_databases, top_k_scores, load_description_matrix
+from hint_index import extract_hints, resolve_db_name
+from main import run_query, run_query_with_result
+from model_runner import run_gpt35, arun_gpt35, arun_gpt35_stream
+from llm_cache import CACHE_READWRITE
+from metrics import traced, span
+import contextvars
 from typing import Tuple
-from langgraph.graph import StateGraph
 
 
 
@@ -21,7 +30,6 @@ from langgraph.graph import StateGraph
 
 
 EMBEDDING_DIR = "schema_embeddings"
-model = SentenceTransformer("all-MiniLM-L6-v2")
 class QueryState(TypedDict):
     question: str
     dbs: list[str]
@@ -33,13 +41,49 @@ class QueryState(TypedDict):
     all_outputs: dict[str, str]
     final_db: str | None          # ✅ New
     final_sql: str | None         # ✅ New
+    question_embedding: object    # normalized np.ndarray, computed once in embed_question
+    db_timings: dict[str, dict]   # per-DB {"seconds", "status"} from generate_sql_multi
+    result_ids: dict[str, str | None]  # per-DB handle for paging full rows
+    final_result_id: str | None
+    decisions: dict[str, dict]    # routing/short-circuit decisions, returned to the caller for tuning
+
+
+
+def initial_state(question: str, db_id: str | None = None, question_embedding=None) -> QueryState:
+    return {
+        "question": question,
+        "dbs": [db_id] if db_id else [],
+        "output": "",
+        "attempt": 0,
+        "hinted_db": None,
+        "hinted_column": None,
+        "gpt_selected_dbs": [],
+        "all_outputs": {},
+        "final_db": None,
+        "final_sql": None,
+        "question_embedding": question_embedding,
+        "db_timings": {},
+        "result_ids": {},
+        "final_result_id": None,
+        "decisions": {}
+    }
 
+_available = (None, frozenset())
 
+def available_databases() -> frozenset:
+    # db_ids with a database directory on disk; re-listed only when that directory changes
+    global _available
+    try:
+        mtime = os.stat(SPIDER_PATH).st_mtime_ns
+    except OSError:
+        return frozenset()
+    if _available[0] != mtime:
+        _available = (mtime, frozenset(list_databases(SPIDER_PATH)))
+    return _available[1]
 
 def resolve_fuzzy_db_name(name: str) -> str | None:
-    all_dbs = list_databases()
-    matches = get_close_matches(name.lower(), all_dbs, n=1, cutoff=0.6)
-    return matches[0] if matches else None
+    # tables.json knows more databases than are installed: only resolve to ones on disk
+    return resolve_db_name(name, available_databases()) if name else None
 
 def resolve_fuzzy_list(names: list[str]) -> list[str]:
     resolved = []
@@ -49,12 +93,40 @@ def resolve_fuzzy_list(names: list[str]) -> list[str]:
             resolved.append(match)
     return resolved
 
-# === Node: Extract hints from user (NEW AGENT) ===
-def extract_context(state: QueryState) -> QueryState:
-    print("🕵️ extract_context")
-    question = state["question"]
+def record_decision(state: QueryState, step: str, action: str, **details) -> dict:
+    return {**(state.get("decisions") or {}), step: {"action": action, **details}}
 
-    prompt = f"""
+def active_stream_writer():
+    # The custom-event writer when the caller asked for the answer token by token
+    # (config={"configurable": {"stream_answer": True}}, as /query/stream does), else None
+    try:
+        if get_config().get("configurable", {}).get("stream_answer"):
+            return get_stream_writer()
+    except RuntimeError:
+        pass
+    return None
+
+def stream_writer():
+    # Custom events for graph.astream(stream_mode="custom"); a no-op outside a graph run
+    try:
+        return get_stream_writer()
+    except RuntimeError:
+        return lambda event: None
+
+def question_embedding_of(state: QueryState):
+    embedding = state.get("question_embedding")
+    return embedding if embedding is not None else encode_question(state["question"])
+
+# === Node: Embed the question once for every downstream node ===
+@traced("node", "embed_question")
+def embed_question(state: QueryState) -> QueryState:
+    print("🧬 embed_question")
+    # /query/batch hands in embeddings from one batched encode
+    return {**state, "question_embedding": question_embedding_of(state)}
+
+# === Node: Extract hints from user (NEW AGENT) ===
+def extract_context_prompt(question: str) -> str:
+    return f"""
 From the following user input, extract the name of a database or column if mentioned.
 
 Return a JSON object with:
@@ -65,16 +137,56 @@ User input:
 \"\"\"{question}\"\"\"
 """.strip()
 
+def apply_context(state: QueryState, response: str) -> QueryState:
+    parsed = json.loads(response)
+    decisions = record_decision(state, "extract_context", "llm", reason="ambiguous")
+    return {**state, "hinted_db": parsed.get("hinted_db"), "hinted_column": parsed.get("hinted_column"), "decisions": decisions}
+
+def local_context(state: QueryState) -> QueryState | None:
+    # Lexical index first; None when the match is ambiguous and GPT should decide
     try:
-        response, _ = run_gpt35(prompt)
-        parsed = json.loads(response)
-        return {**state, "hinted_db": parsed.get("hinted_db"), "hinted_column": parsed.get("hinted_column")}
+        hints = extract_hints(state["question"])
+    except Exception as e:
+        print(f"⚠️ Local hint index unavailable: {e}")
+        return None
+    if hints["ambiguous"]:
+        print(f"🤔 Ambiguous DB mention: {hints['named_dbs']}")
+        return None
+    decisions = record_decision(
+        state, "extract_context", "local",
+        hinted_db=hints["hinted_db"], db_score=hints["db_score"],
+        hinted_column=hints["hinted_column"], column_score=hints["column_score"],
+    )
+    return {**state, "hinted_db": hints["hinted_db"], "hinted_column": hints["hinted_column"], "decisions": decisions}
+
+@traced("node", "extract_context")
+def extract_context(state: QueryState) -> QueryState:
+    print("🕵️ extract_context")
+    local = local_context(state)
+    if local is not None:
+        return local
+    try:
+        response, _ = run_gpt35(extract_context_prompt(state["question"]), cache=CACHE_READWRITE)
+        return apply_context(state, response)
     except Exception as e:
         print(f"⚠️ Failed to extract context: {e}")
         return {**state, "hinted_db": None, "hinted_column": None}
 
-def format_with_gpt(raw_output: str, question: str) -> str:
-    prompt = f"""
+@traced("node", "extract_context")
+async def aextract_context(state: QueryState) -> QueryState:
+    print("🕵️ extract_context")
+    local = local_context(state)
+    if local is not None:
+        return local
+    try:
+        response, _ = await arun_gpt35(extract_context_prompt(state["question"]), cache=CACHE_READWRITE)
+        return apply_context(state, response)
+    except Exception as e:
+        print(f"⚠️ Failed to extract context: {e}")
+        return {**state, "hinted_db": None, "hinted_column": None}
+
+def format_prompt(raw_output: str, question: str) -> str:
+    return f"""
 You are a helpful assistant.
 
 Rewrite the database output into a clean, natural, and concise sentence that directly answers the question.
@@ -96,18 +208,53 @@ Database result:
 Final answer:
 """.strip()
 
+def format_with_gpt(raw_output: str, question: str) -> str:
+    try:
+        response, _ = run_gpt35(format_prompt(raw_output, question), cache=CACHE_READWRITE)
+        return response.strip()
+    except Exception as e:
+        print(f"⚠️ GPT formatting failed: {e}")
+        return raw_output  # fallback if GPT fails
+
+async def aformat_with_gpt(raw_output: str, question: str) -> str:
+    # Streams the rewrite token by token only when /query/stream is listening; otherwise the
+    # plain call keeps its retries (a stream can't be retried once the first token is out)
+    writer = active_stream_writer()
+    if writer is None:
+        try:
+            response, _ = await arun_gpt35(format_prompt(raw_output, question), cache=CACHE_READWRITE)
+            return response.strip()
+        except Exception as e:
+            print(f"⚠️ GPT formatting failed: {e}")
+            return raw_output  # fallback if GPT fails
+
+    sent = False
+
+    def on_delta(text):
+        nonlocal sent
+        sent = True
+        writer({"event": "answer_delta", "text": text})
+
     try:
-        response, _ = run_gpt35(prompt)
+        response, _ = await arun_gpt35_stream(format_prompt(raw_output, question), on_delta, cache=CACHE_READWRITE)
         return response.strip()
     except Exception as e:
         print(f"⚠️ GPT formatting failed: {e}")
+        if sent:
+            # The client already shows part of an answer: tell it to replace that with the fallback
+            writer({"event": "answer_reset", "text": raw_output, "error": str(e)})
         return raw_output  # fallback if GPT fails
 
 
 
+@traced("node", "retrieve_schema")
 def retrieve_schema(state: QueryState) -> QueryState:
     print("🔍 retrieve_schema")
-    question = state["question"]
+    # Priority 0: DBs fixed by the request or by route_databases
+    if state.get("dbs"):
+        print(f"📌 Using routed DBs: {state['dbs']}")
+        return state
+
     # Priority 1: use hinted_db if specified
     if state.get("hinted_db"):
         raw_hint = state["hinted_db"]
@@ -128,21 +275,12 @@ def retrieve_schema(state: QueryState) -> QueryState:
             print("⚠️ No valid DBs from GPT-selected list.")
 
     # Fallback: use embeddings
-    question_embedding = model.encode(question, convert_to_tensor=True)
-    relevance_scores = []
-
-    for db_id in list_databases():
-        emb_path = os.path.join(EMBEDDING_DIR, f"{db_id}.pt")
-        if not os.path.exists(emb_path):
-            continue
-        try:
-            schema_emb = torch.load(emb_path)
-            score = util.pytorch_cos_sim(question_embedding, schema_emb).item()
-            relevance_scores.append((score, db_id))
-        except Exception as e:
-            print(f"⚠️ Skipping {db_id}: {e}")
-
-    top_dbs = [db_id for _, db_id in sorted(relevance_scores, reverse=True)[:3]]
+    question_embedding = question_embedding_of(state)
+    try:
+        top_dbs = [db_id for _, db_id in top_k_databases(question_embedding, k=3)]
+    except Exception as e:
+        print(f"⚠️ DB embedding matrix unavailable: {e}")
+        top_dbs = []
 
     if not top_dbs:
         print("❌ No databases found via embedding fallback.")
@@ -153,9 +291,7 @@ def retrieve_schema(state: QueryState) -> QueryState:
 
 
 
-def select_best_answer(state: QueryState) -> QueryState:
-    print("🧠 select_best_answer ()")
-
+def select_best_prompt(state: QueryState) -> str:
     question = state["question"]
     all_outputs = state.get("all_outputs", {})
     print("🧾 All outputs seen by GPT:")
@@ -166,7 +302,7 @@ def select_best_answer(state: QueryState) -> QueryState:
     formatted_outputs = json.dumps(all_outputs, indent=2)
 
 
-    prompt = f"""
+    return f"""
 You are selecting the most relevant database output for the user's question.
 
 Question:
@@ -179,54 +315,73 @@ Below is a JSON object where keys are database names and values are their respec
 Pick the best database name key (e.g. "cinema") that gives the most complete and relevant answer. Return only the key.
 """
 
+def choose_output(state: QueryState, selected_db: str) -> QueryState:
+    selected_output = state.get("all_outputs", {})[selected_db].strip()
+    sql_match = re.search(r"📝 SQL used:\n(.+)", selected_output, re.DOTALL)
+    extracted_sql = sql_match.group(1).strip() if sql_match else "SQL not found"
+    return {
+    **state,
+    "output": selected_output,
+    "final_db": selected_db,
+    "final_sql": extracted_sql,
+    "final_result_id": state.get("result_ids", {}).get(selected_db),
+    }
+
+def apply_best_answer(state: QueryState, response: str) -> QueryState:
+    all_outputs = state.get("all_outputs", {})
+    selected_db_raw = response.strip().strip('"').strip("'").lower()
+
+    # Fuzzy match GPT's selection to valid db keys in all_outputs
+    possible_dbs = list(all_outputs.keys())
+    matched = get_close_matches(selected_db_raw, possible_dbs, n=1, cutoff=0.6)
+
+    if matched:
+        selected_db = matched[0]
+        print(f"✅ GPT selected DB (matched): {selected_db}")
+        decisions = record_decision(state, "select_best_answer", "llm", candidates=len(all_outputs))
+        return choose_output({**state, "decisions": decisions}, selected_db)
+    else:
+        print(f"❌ No match for GPT-selected DB: {selected_db_raw}")
+        return {**state, "output": f"No valid database selected: {selected_db_raw}"}
+
+@traced("node", "select_best_answer")
+def select_best_answer(state: QueryState) -> QueryState:
+    print("🧠 select_best_answer ()")
     try:
-        response, _ = run_gpt35(prompt)
-        selected_db_raw = response.strip().strip('"').strip("'").lower()
+        response, _ = run_gpt35(select_best_prompt(state), cache=CACHE_READWRITE)
+        return apply_best_answer(state, response)
+    except Exception as e:
+        print(f"⚠️ Failed to select best answer: {e}")
+        return {**state, "output": "Error selecting best answer."}
 
-        # Fuzzy match GPT's selection to valid db keys in all_outputs
-        possible_dbs = list(all_outputs.keys())
-        matched = get_close_matches(selected_db_raw, possible_dbs, n=1, cutoff=0.6)
-        
-        if matched:
-            selected_db = matched[0]
-            print(f"✅ GPT selected DB (matched): {selected_db}")
-            selected_output = all_outputs[selected_db].strip()
-            import re
-            sql_match = re.search(r"📝 SQL used:\n(.+)", selected_output, re.DOTALL)
-            extracted_sql = sql_match.group(1).strip() if sql_match else "SQL not found"
-            return {
-            **state,
-            "output": selected_output,
-            "final_db": selected_db,
-            "final_sql": extracted_sql,
-            }
-        else:
-            print(f"❌ No match for GPT-selected DB: {selected_db_raw}")
-            return {**state, "output": f"No valid database selected: {selected_db_raw}"}
+@traced("node", "select_best_answer")
+async def aselect_best_answer(state: QueryState) -> QueryState:
+    print("🧠 select_best_answer ()")
+    try:
+        response, _ = await arun_gpt35(select_best_prompt(state), cache=CACHE_READWRITE)
+        return apply_best_answer(state, response)
     except Exception as e:
         print(f"⚠️ Failed to select best answer: {e}")
         return {**state, "output": "Error selecting best answer."}
 
 
-def select_databases_with_gpt(state: QueryState) -> QueryState:
-    print("🧠 select_databases_with_gpt")
+def shortlist_databases(state: QueryState) -> tuple[list[str], str]:
+    # Returns the embedding top-k and the GPT prompt that ranks them
     question = state["question"]
     from description_utils import load_descriptions
     descriptions = load_descriptions()
 
     # --- Step 1: use embeddings to narrow down to top-k ---
-    db_ids = list(descriptions.keys())
-    question_embedding = model.encode(question, convert_to_tensor=True)
-
-    scores = []
-    for db_id in db_ids:
-        desc_text = descriptions[db_id].get("description", "")
-        desc_embedding = model.encode(desc_text, convert_to_tensor=True)
-        score = util.pytorch_cos_sim(question_embedding, desc_embedding).item()
-        scores.append((score, db_id))
+    desc_matrix, db_ids = load_description_matrix(
+        descriptions,
+        get_embedding_service().encode,
+        EMBEDDING_MODEL,
+    )
+    question_embedding = question_embedding_of(state)
 
     top_k = 8
-    top_dbs = [db_id for _, db_id in sorted(scores, reverse=True)[:top_k]]
+    top_idx, _ = top_k_scores(desc_matrix, question_embedding, top_k)
+    top_dbs = [db_ids[i] for i in top_idx]
 
     # --- Step 2: format a short GPT prompt using only those ---
     top_descriptions = "\n".join(
@@ -243,9 +398,15 @@ Here are descriptions of candidate databases:
 
 Return a JSON list (e.g., ["db1", "db2"]) of the most relevant databases in order of relevance.
 """.strip()
+    return top_dbs, prompt
+
+@traced("node", "select_databases_with_gpt")
+def select_databases_with_gpt(state: QueryState) -> QueryState:
+    print("🧠 select_databases_with_gpt")
+    top_dbs, prompt = shortlist_databases(state)
 
     try:
-        gpt_response, _ = run_gpt35(prompt)
+        gpt_response, _ = run_gpt35(prompt, cache=CACHE_READWRITE)
         selected = json.loads(gpt_response)
         print(f"✅ GPT selected DBs: {selected}")
         return {**state, "gpt_selected_dbs": selected}
@@ -253,50 +414,130 @@ Return a JSON list (e.g., ["db1", "db2"]) of the most relevant databases in orde
         print(f"⚠️ GPT DB selection failed: {e}")
         return {**state, "gpt_selected_dbs": top_dbs}  # fallback to top-k
 
+@traced("node", "select_databases_with_gpt")
+async def aselect_databases_with_gpt(state: QueryState) -> QueryState:
+    print("🧠 select_databases_with_gpt")
+    top_dbs, prompt = await asyncio.to_thread(shortlist_databases, state)
 
+    try:
+        gpt_response, _ = await arun_gpt35(prompt, cache=CACHE_READWRITE)
+        selected = json.loads(gpt_response)
+        print(f"✅ GPT selected DBs: {selected}")
+        return {**state, "gpt_selected_dbs": selected}
+    except Exception as e:
+        print(f"⚠️ GPT DB selection failed: {e}")
+        return {**state, "gpt_selected_dbs": top_dbs}  # fallback to top-k
 
-def generate_sql_multi(state: QueryState) -> QueryState:
-    print("🧠 generate_sql_multi")
-
-    question = state["question"]
-    dbs = state.get("dbs", [])
-    all_outputs = {}
-
-    for db_id in dbs:
-        print(f"📊 Trying DB: {db_id}")
-        try:
-            sql, result = run_query(db_id, question)
-
-            # Ensure both sql and result are strings
-            result_str = str(result) if result is not None else "(No result returned)"
-            sql_str = str(sql) if sql is not None else "SQL generation failed"
-
-            # Safely combine
-            combined = result_str + f"\n\n📝 SQL used:\n{sql_str}"
-            all_outputs[db_id] = combined
 
-        except Exception as e:
-            all_outputs[db_id] = f"[Execution error on {db_id}] {e}"
 
-    return {**state, "all_outputs": all_outputs}
+def run_db_query(db_id: str, question: str, question_embedding, started_at: dict, dbs: list[str], overall_deadline: float) -> tuple[str, str | None]:
+    started_at[db_id] = started = time.perf_counter()
+    print(f"📊 Trying DB: {db_id}")
+    # Once generate_sql_multi stops waiting, this worker starts no new LLM call or query
+    deadline = min(started + FANOUT_DB_TIMEOUT, overall_deadline)
+    with span("run_query", db_id):
+        sql, result, result_id = run_query_with_result(db_id, question, question_embedding, candidate_dbs=dbs, deadline=deadline)
 
+    # Ensure both sql and result are strings
+    result_str = str(result) if result is not None else "(No result returned)"
+    sql_str = str(sql) if sql is not None else "SQL generation failed"
 
+    # Safely combine
+    return result_str + f"\n\n📝 SQL used:\n{sql_str}", result_id
 
 
-def final_output(state: QueryState) -> QueryState:
-    print("🏁 final_output")
+def db_result_event(db_id: str, output: str, timing: dict, result_id: str | None) -> dict:
+    sql_match = re.search(r"📝 SQL used:\n(.+)", output, re.DOTALL)
+    return {
+        "event": "db_result",
+        "db": db_id,
+        "sql": sql_match.group(1).strip() if sql_match else None,
+        "result": answer_of(output),
+        "result_id": result_id,
+        **timing,
+    }
 
-    raw = state.get("output", "")
-    question = state.get("question", "")
-    formatted = format_with_gpt(raw, question)
+@traced("node", "generate_sql_multi")
+def generate_sql_multi(state: QueryState) -> QueryState:
+    print("🧠 generate_sql_multi")
 
+    question = state["question"]
+    question_embedding = question_embedding_of(state)
+    dbs = state.get("dbs", [])
+    if not dbs:
+        return {**state, "all_outputs": {}, "db_timings": {}, "result_ids": {}}
+
+    workers = max(1, min(FANOUT_CONCURRENCY, len(dbs)))
+    # A hung DB keeps its worker thread, so bound the whole fan-out as well
+    overall_deadline = time.perf_counter() + FANOUT_DB_TIMEOUT * math.ceil(len(dbs) / workers)
+    started_at = {}
+    outputs = {}
+    result_ids = {}
+    timings = {}
+
+    writer = stream_writer()
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="fanout")
+    futures = {
+        executor.submit(contextvars.copy_context().run, run_db_query, db_id, question, question_embedding, started_at, dbs, overall_deadline): db_id
+        for db_id in dbs
+    }
+    pending = set(futures)
+
+    while pending:
+        now = time.perf_counter()
+        running_deadlines = [started_at[futures[f]] + FANOUT_DB_TIMEOUT for f in pending if futures[f] in started_at]
+        next_deadline = min(running_deadlines + [overall_deadline])
+        done, pending = wait(pending, timeout=max(0.0, next_deadline - now), return_when=FIRST_COMPLETED)
+
+        for future in done:
+            db_id = futures[future]
+            elapsed = time.perf_counter() - started_at.get(db_id, now)
+            try:
+                outputs[db_id], result_ids[db_id] = future.result()
+                status = "error" if "SQL generation failed" in outputs[db_id] else "ok"
+            except Exception as e:
+                outputs[db_id] = f"[Execution error on {db_id}] {e}"
+                status = "error"
+            timings[db_id] = {"seconds": round(elapsed, 3), "status": status}
+            print(f"⏱️ {db_id}: {status} in {elapsed:.2f}s")
+            writer(db_result_event(db_id, outputs[db_id], timings[db_id], result_ids.get(db_id)))
+
+        now = time.perf_counter()
+        for future in list(pending):
+            db_id = futures[future]
+            started = started_at.get(db_id)
+            timed_out = started is not None and now - started >= FANOUT_DB_TIMEOUT
+            if timed_out or now >= overall_deadline:
+                future.cancel()
+                pending.discard(future)
+                if started is not None:
+                    status = "timeout"
+                    outputs[db_id] = f"[Execution error on {db_id}] timeout after {FANOUT_DB_TIMEOUT:g}s"
+                else:
+                    # Never got a worker before the fan-out deadline: it did not run at all
+                    status = "not_started"
+                    outputs[db_id] = f"[Execution error on {db_id}] not started: fan-out deadline reached"
+                timings[db_id] = {"seconds": round(now - started, 3) if started else 0.0, "status": status}
+                print(f"⏱️ {db_id}: {status}")
+                writer(db_result_event(db_id, outputs[db_id], timings[db_id], None))
+
+    executor.shutdown(wait=False, cancel_futures=True)
+
+    # Keep the routing order so downstream prompts stay deterministic
+    all_outputs = {db_id: outputs[db_id] for db_id in dbs}
+    return {**state, "all_outputs": all_outputs, "db_timings": timings, "result_ids": result_ids}
+
+
+
+
+def finish_output(state: QueryState, formatted: str) -> QueryState:
     final_db = state.get("final_db", "Unknown")
     final_sql = state.get("final_sql", "SQL not found")
     gpt_candidates = state.get("gpt_selected_dbs", [])
 
     print("\n🟢 Final Answer:\n" + formatted)
     print("\n📦 Found in DB:", final_db)
-    print("\n🧾 SQL Used:\n" + final_sql)
+    print("\n🧾 SQL Used:\n" + str(final_sql))
     print("\n🎯 GPT Candidate DBs:", gpt_candidates)
 
     return {
@@ -307,28 +548,155 @@ def final_output(state: QueryState) -> QueryState:
         "gpt_selected_dbs": gpt_candidates
     }
 
+@traced("node", "final_output")
+def final_output(state: QueryState) -> QueryState:
+    print("🏁 final_output")
+    formatted = format_with_gpt(state.get("output", ""), state.get("question", ""))
+    return finish_output({**state, "decisions": record_decision(state, "final_output", "llm")}, formatted)
+
+@traced("node", "final_output")
+async def afinal_output(state: QueryState) -> QueryState:
+    print("🏁 final_output")
+    formatted = await aformat_with_gpt(state.get("output", ""), state.get("question", ""))
+    return finish_output({**state, "decisions": record_decision(state, "final_output", "llm")}, formatted)
+
+
+
+# === Conditional routing: skip LLM steps whose outcome is already decided ===
+def answer_of(output: str) -> str:
+    # The answer text without the "📝 SQL used" suffix added by run_db_query
+    return output.split("\n\n📝 SQL used:")[0].strip()
+
+def is_usable_answer(answer: str) -> bool:
+    # Errors start with "[...]" or "(⚠️ ...)"; empty results carry nothing to choose between
+    return bool(answer) and not answer.startswith(("[", "(", "The result is empty."))
+
+def usable_outputs(state: QueryState) -> list[str]:
+    timings = state.get("db_timings", {})
+    return [
+        db_id for db_id, output in state.get("all_outputs", {}).items()
+        if timings.get(db_id, {}).get("status", "ok") == "ok" and is_usable_answer(answer_of(output))
+    ]
+
+def direct_answer_reason(state: QueryState) -> str | None:
+    # Answers that GPT rewriting cannot improve: single scalars and non-answers
+    answer = answer_of(state.get("output", ""))
+    if re.fullmatch(r"The result is: [^\n]*\.", answer):
+        return "scalar"
+    if not state.get("final_db") or not is_usable_answer(answer):
+        return "no_result"
+    return None
+
+@traced("node", "route_databases")
+def route_databases(state: QueryState) -> QueryState:
+    print("🚦 route_databases")
+    if state.get("dbs"):
+        decisions = record_decision(state, "extract_context", "skipped", reason="db_id given")
+        decisions = record_decision({"decisions": decisions}, "route_databases", "requested", dbs=state["dbs"])
+        return {**state, "decisions": decisions}
+
+    if state.get("hinted_db"):
+        matched = resolve_fuzzy_db_name(state["hinted_db"])
+        if matched:
+            print(f"🎯 Hinted DB matched: {state['hinted_db']} → {matched}")
+            decisions = record_decision(state, "route_databases", "hinted_db", dbs=[matched], hint=state["hinted_db"])
+            return {**state, "dbs": [matched], "decisions": decisions}
+
+    details = {}
+    try:
+        ranked = top_k_databases(question_embedding_of(state), k=2)
+    except Exception as e:
+        print(f"⚠️ DB embedding matrix unavailable: {e}")
+        ranked = []
+    if ranked:
+        top_score, top_db = ranked[0]
+        margin = top_score - ranked[1][0] if len(ranked) > 1 else top_score
+        details = {"top": [[db_id, round(score, 4)] for score, db_id in ranked], "margin": round(margin, 4)}
+        if top_score >= ROUTE_MIN_SCORE and margin >= ROUTE_MARGIN:
+            print(f"🎯 Embedding margin {margin:.3f} → {top_db}")
+            decisions = record_decision(state, "route_databases", "embedding_margin", dbs=[top_db], **details)
+            return {**state, "dbs": [top_db], "decisions": decisions}
+
+    return {**state, "decisions": record_decision(state, "route_databases", "ask_gpt", **details)}
+
+@traced("node", "pick_single_answer")
+def pick_single_answer(state: QueryState) -> QueryState:
+    print("☝️ pick_single_answer")
+    all_outputs = state.get("all_outputs", {})
+    usable = usable_outputs(state)
+    if not all_outputs:
+        decisions = record_decision(state, "select_best_answer", "skipped", reason="no_outputs")
+        return {**state, "output": "No meaningful answer found.", "decisions": decisions}
+
+    # Fall back to the first DB in routing order when nothing usable came back
+    selected_db = usable[0] if usable else next(iter(all_outputs))
+    reason = "single_db" if len(all_outputs) == 1 else ("single_usable" if usable else "no_usable")
+    decisions = record_decision(state, "select_best_answer", "skipped", reason=reason, selected=selected_db)
+    return choose_output({**state, "decisions": decisions}, selected_db)
 
+@traced("node", "final_output_direct")
+def final_output_direct(state: QueryState) -> QueryState:
+    print("🏁 final_output (no LLM)")
+    decisions = record_decision(state, "final_output", "skipped", reason=direct_answer_reason(state))
+    answer = answer_of(state.get("output", ""))
+    stream_writer()({"event": "answer_delta", "text": answer})
+    return finish_output({**state, "decisions": decisions}, answer)
 
+def route_after_embedding(state: QueryState) -> str:
+    # A db_id from the request makes hint extraction pointless
+    return "route_databases" if state.get("dbs") else "extract_context"
 
+def route_after_routing(state: QueryState) -> str:
+    return "retrieve_schema" if state.get("dbs") else "select_databases_with_gpt"
+
+def route_after_fanout(state: QueryState) -> str:
+    if len(state.get("all_outputs", {})) <= 1 or len(usable_outputs(state)) <= 1:
+        return "pick_single_answer"
+    return "select_best_answer"
+
+def route_final(state: QueryState) -> str:
+    return "final_output_direct" if direct_answer_reason(state) else "final_output"
 
 
 
 def build_graph():
     graph = StateGraph(QueryState)
 
-    graph.add_node("extract_context", extract_context)
-    graph.add_node("select_databases_with_gpt", select_databases_with_gpt)
+    graph.add_node("embed_question", embed_question)
+    # LLM nodes get a native async variant for graph.ainvoke; the rest run in the executor
+    graph.add_node("extract_context", RunnableLambda(extract_context, afunc=aextract_context))
+    graph.add_node("select_databases_with_gpt", RunnableLambda(select_databases_with_gpt, afunc=aselect_databases_with_gpt))
     graph.add_node("retrieve_schema", retrieve_schema)
     graph.add_node("generate_sql_multi", generate_sql_multi)
-    graph.add_node("select_best_answer", select_best_answer)
-    graph.add_node("final_output", final_output)
-
-    graph.set_entry_point("extract_context")
-    graph.add_edge("extract_context", "select_databases_with_gpt")
+    graph.add_node("select_best_answer", RunnableLambda(select_best_answer, afunc=aselect_best_answer))
+    graph.add_node("final_output", RunnableLambda(final_output, afunc=afinal_output))
+
+    graph.set_entry_point("embed_question")
+
+    if not CONDITIONAL_ROUTING:
+        # Fixed chain: every LLM step runs for every question
+        graph.add_edge("embed_question", "extract_context")
+        graph.add_edge("extract_context", "select_databases_with_gpt")
+        graph.add_edge("select_databases_with_gpt", "retrieve_schema")
+        graph.add_edge("retrieve_schema", "generate_sql_multi")
+        graph.add_edge("generate_sql_multi", "select_best_answer")
+        graph.add_edge("select_best_answer", "final_output")
+        graph.set_finish_point("final_output")
+        return graph.compile()
+
+    graph.add_node("route_databases", route_databases)
+    graph.add_node("pick_single_answer", pick_single_answer)
+    graph.add_node("final_output_direct", final_output_direct)
+
+    graph.add_conditional_edges("embed_question", route_after_embedding, ["extract_context", "route_databases"])
+    graph.add_edge("extract_context", "route_databases")
+    graph.add_conditional_edges("route_databases", route_after_routing, ["select_databases_with_gpt", "retrieve_schema"])
     graph.add_edge("select_databases_with_gpt", "retrieve_schema")
     graph.add_edge("retrieve_schema", "generate_sql_multi")
-    graph.add_edge("generate_sql_multi", "select_best_answer")
-    graph.add_edge("select_best_answer", "final_output")
+    graph.add_conditional_edges("generate_sql_multi", route_after_fanout, ["select_best_answer", "pick_single_answer"])
+    graph.add_conditional_edges("select_best_answer", route_final, ["final_output", "final_output_direct"])
+    graph.add_conditional_edges("pick_single_answer", route_final, ["final_output", "final_output_direct"])
 
     graph.set_finish_point("final_output")
+    graph.set_finish_point("final_output_direct")
     return graph.compile()
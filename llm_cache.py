@@ -0,0 +1,126 @@
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "llm_cache.sqlite")
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", str(7 * 24 * 3600)))
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "100000"))
+
+# Per-call-site cache modes
+CACHE_OFF = "off"
+CACHE_READ = "read"              # serve hits, never store
+CACHE_WRITE = "write"            # always call the model, store the answer
+CACHE_READWRITE = "readwrite"    # read-through + write-through
+CACHE_MODES = (CACHE_OFF, CACHE_READ, CACHE_WRITE, CACHE_READWRITE)
+
+
+def normalize_prompt(prompt):
+    return re.sub(r"\s+", " ", prompt).strip()
+
+
+def cache_key(model, temperature, prompt):
+    raw = f"{model}\0{temperature}\0{normalize_prompt(prompt)}"
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+class LLMCache:
+    # SQLite-backed response cache with TTL expiry and LRU eviction beyond max_entries
+
+    def __init__(self, path=LLM_CACHE_PATH, ttl=LLM_CACHE_TTL, max_entries=LLM_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                model TEXT,
+                temperature REAL,
+                response TEXT,
+                tokens INTEGER,
+                created_at REAL,
+                accessed_at REAL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+        self._size = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response, tokens, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            if now - row[2] > self.ttl:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._size -= 1
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+            self.hits += 1
+            return row[0], row[1]
+
+    def set(self, key, model, temperature, response, tokens):
+        now = time.time()
+        with self._lock:
+            existed = self._conn.execute("SELECT 1 FROM responses WHERE key = ?", (key,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, model, temperature, response, tokens, now, now),
+            )
+            self.writes += 1
+            if not existed:
+                self._size += 1
+            if self._size > self.max_entries:
+                self._evict(now)
+
+    def _evict(self, now):
+        # Drop expired rows first, then least recently used down to 90% of the cap
+        expired = self._conn.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl,)).rowcount
+        self._size -= expired
+        excess = self._size - int(self.max_entries * 0.9)
+        if excess > 0:
+            self._conn.execute(
+                "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY accessed_at LIMIT ?)",
+                (excess,),
+            )
+            self._size -= excess
+        self.evictions += expired + max(excess, 0)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": self._size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "writes": self.writes,
+                "evictions": self.evictions,
+            }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_llm_cache():
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = LLMCache()
+    return _cache
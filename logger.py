@@ -1,15 +1,229 @@
+import atexit
 import csv
+import json
 import os
+import queue
+import sqlite3
+import threading
+from datetime import datetime
 
-def init_csv_log(filename="results_log.csv"):
-    if not os.path.exists(filename):
-        with open(filename, mode="w", newline="") as f:
+# The live log is its own file so the tracked legacy results_log.csv (the benchmark's
+# default workload, old 6-column header) is never rotated into the archive and deleted
+LOG_FILE = os.getenv("RESULTS_LOG", "results.csv")
+LOG_ARCHIVE = os.getenv("LOG_ARCHIVE", "results_archive.sqlite")
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(16 * 1024 * 1024)))
+LOG_ROTATE_DAILY = os.getenv("LOG_ROTATE_DAILY", "1") == "1"
+LOG_BATCH_SIZE = int(os.getenv("LOG_BATCH_SIZE", "200"))
+LOG_FLUSH_INTERVAL = float(os.getenv("LOG_FLUSH_INTERVAL", "1.0"))
+LOG_QUEUE_MAX = int(os.getenv("LOG_QUEUE_MAX", "100000"))
+
+LOG_COLUMNS = [
+    "timestamp", "db_id", "question", "gpt_sql", "result", "error", "tokens",
+    "latency_ms", "stage_latencies", "candidate_dbs", "cache_hits", "sql_guard",
+]
+# Fields stored as JSON text in both the CSV and the archive
+JSON_COLUMNS = ("stage_latencies", "candidate_dbs", "cache_hits", "sql_guard")
+
+
+def _create_archive(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS results (
+            timestamp TEXT,
+            db_id TEXT,
+            question TEXT,
+            gpt_sql TEXT,
+            result TEXT,
+            error TEXT,
+            tokens INTEGER,
+            latency_ms REAL,
+            stage_latencies TEXT,
+            candidate_dbs TEXT,
+            cache_hits TEXT,
+            segment TEXT
+        )
+    """)
+    # Archives created before a column existed get it appended
+    existing = {row[1] for row in conn.execute("PRAGMA table_info(results)")}
+    for column in LOG_COLUMNS:
+        if column not in existing:
+            conn.execute(f"ALTER TABLE results ADD COLUMN {column} TEXT")
+    conn.execute("CREATE INDEX IF NOT EXISTS results_db_id ON results (db_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS results_timestamp ON results (timestamp)")
+
+
+def compact_segment(segment_path, archive_path=LOG_ARCHIVE):
+    # Load a rotated CSV segment into the SQLite archive, then remove it.
+    # Older segments with the original 6-column header are accepted too.
+    csv.field_size_limit(1 << 30)
+    conn = sqlite3.connect(archive_path)
+    try:
+        _create_archive(conn)
+        segment = os.path.basename(segment_path)
+        insert = f"INSERT INTO results ({', '.join(LOG_COLUMNS)}, segment) VALUES ({','.join('?' * (len(LOG_COLUMNS) + 1))})"
+        with open(segment_path, newline="") as f:
+            reader = csv.DictReader(f)
+            batch = []
+            for row in reader:
+                batch.append([row.get(column) or None for column in LOG_COLUMNS] + [segment])
+                if len(batch) >= 5000:
+                    conn.executemany(insert, batch)
+                    batch = []
+            if batch:
+                conn.executemany(insert, batch)
+        conn.commit()
+    finally:
+        conn.close()
+    os.remove(segment_path)
+
+
+class LogWriter:
+    # Request threads only enqueue; one daemon thread batches rows to the CSV,
+    # rotates it by size/date and compacts rotated segments into the archive.
+
+    def __init__(self, filename=LOG_FILE, archive_path=LOG_ARCHIVE):
+        self.filename = filename
+        self.archive_path = archive_path
+        self._queue = queue.Queue(maxsize=LOG_QUEUE_MAX)
+        self.dropped = 0
+        self.written = 0
+        self._opened_on = None
+        self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _prepare_file(self):
+        if os.path.exists(self.filename):
+            with open(self.filename, newline="") as f:
+                header = next(csv.reader(f), None)
+            if header != LOG_COLUMNS:
+                self._rotate()
+        if not os.path.exists(self.filename):
+            with open(self.filename, mode="w", newline="") as f:
+                csv.writer(f).writerow(LOG_COLUMNS)
+        self._opened_on = datetime.fromtimestamp(os.path.getmtime(self.filename)).date()
+
+    def _rotate(self):
+        base, ext = os.path.splitext(self.filename)
+        segment = f"{base}.{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}{ext}"
+        os.replace(self.filename, segment)
+        try:
+            compact_segment(segment, self.archive_path)
+            print(f"🗜️ Archived {segment} into {self.archive_path}")
+        except Exception as e:
+            print(f"⚠️ Failed to archive {segment}: {e}")
+
+    def _needs_rotation(self):
+        if os.path.getsize(self.filename) >= LOG_MAX_BYTES:
+            return True
+        return LOG_ROTATE_DAILY and datetime.now().date() != self._opened_on
+
+    def submit(self, record):
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _drain(self):
+        batch = []
+        try:
+            batch.append(self._queue.get(timeout=LOG_FLUSH_INTERVAL))
+            while len(batch) < LOG_BATCH_SIZE:
+                batch.append(self._queue.get_nowait())
+        except queue.Empty:
+            pass
+        return batch
+
+    def _write(self, batch):
+        try:
+            rotate = self._needs_rotation()
+        except OSError:
+            # The file is gone (removed externally, or _prepare_file failed earlier): start a new one
+            print(f"⚠️ {self.filename} is missing, recreating it")
+            self._prepare_file()
+            rotate = False
+        if rotate:
+            self._rotate()
+            self._prepare_file()
+        with open(self.filename, mode="a", newline="") as f:
             writer = csv.writer(f)
-            writer.writerow(["db_id", "question", "gpt_sql", "result", "error", "tokens"])
+            writer.writerows([record.get(column) for column in LOG_COLUMNS] for record in batch)
+        self.written += len(batch)
+
+    def _run(self):
+        # Runs off the request path: a legacy header triggers a full rotation + compaction here
+        try:
+            self._prepare_file()
+        except Exception as e:
+            print(f"⚠️ Failed to prepare {self.filename}: {e}")
+
+        while True:
+            batch = self._drain()
+            if not batch:
+                continue
+            stop = any(record is None for record in batch)
+            batch = [record for record in batch if record is not None]
+            try:
+                if batch:
+                    self._write(batch)
+            except Exception as e:
+                self.dropped += len(batch)
+                print(f"⚠️ Failed to write {len(batch)} log rows ({self.dropped} dropped so far): {e}")
+            if stop:
+                return
+
+    def close(self, timeout=5.0):
+        if self._thread.is_alive():
+            try:
+                self._queue.put(None, timeout=timeout)
+            except queue.Full:
+                return
+            self._thread.join(timeout)
+
+
+_writers = {}
+_writers_lock = threading.Lock()
+
+
+def _get_writer(filename):
+    writer = _writers.get(filename)
+    if writer is None:
+        with _writers_lock:
+            writer = _writers.get(filename)
+            if writer is None:
+                writer = _writers[filename] = LogWriter(filename)
+    return writer
+
+
+def init_csv_log(filename=LOG_FILE):
+    _get_writer(filename)
+
 
+def log_result(db_id, question, sql, result, error=None, tokens=None, filename=LOG_FILE,
+               latency_ms=None, stage_latencies=None, candidate_dbs=None, cache_hits=None, sql_guard=None):
+    record = {
+        "timestamp": datetime.now().isoformat(timespec="milliseconds"),
+        "db_id": db_id,
+        "question": question,
+        "gpt_sql": sql,
+        "result": result,
+        "error": error,
+        "tokens": tokens,
+        "latency_ms": round(latency_ms, 1) if latency_ms is not None else None,
+        "stage_latencies": stage_latencies,
+        "candidate_dbs": candidate_dbs,
+        "cache_hits": cache_hits,
+        "sql_guard": sql_guard,
+    }
+    for column in JSON_COLUMNS:
+        if record[column] is not None:
+            record[column] = json.dumps(record[column])
+    _get_writer(filename).submit(record)
 
-def log_result(db_id, question, sql, result, error=None, tokens=None, filename="results_log.csv"):
-    with open(filename, mode="a", newline="") as f:
-        writer = csv.writer(f)
-        writer.writerow([db_id, question, sql, result, error, tokens])
 
+def log_stats():
+    with _writers_lock:
+        writers = list(_writers.values())
+    return {
+        writer.filename: {"queued": writer._queue.qsize(), "written": writer.written, "dropped": writer.dropped}
+        for writer in writers
+    }
@@ -2,22 +2,58 @@ import sys
 import os
 import sqlite3
 import re
+import threading
 import time
-import torch
 from schema_utils import load_schema_chunks, list_databases
-from vector_store import RAGRetriever
+from schema_snapshot import get_snapshot
+from db_router import top_k_databases
+import sqlite_pool
+from sqlite_pool import SQL_TIMEOUT, SQL_MAX_ROWS, ResultRows
+from sql_guard import guard_sql, SQLRejected
+import result_store
+from vector_store import RAGRetriever, collection_lock
 from model_runner import run_gpt35, convert_sql_to_answer
+from prompt_builder import build_sql_prompt
+from llm_cache import CACHE_READWRITE
 from evaluator import evaluate_sql_outputs
 from sqlparse import format as format_sql
 from description_utils import load_descriptions, enrich_schema_with_descriptions
-from logger import init_csv_log, log_result
-from sentence_transformers import SentenceTransformer, util
+from logger import log_result
+from embedding_service import encode_question
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
-init_csv_log()
+# No import-time work: the results log, chunk index, LLM client and embedding model
+# are all created on first use (see warmup.py for loading them ahead of traffic)
 SPIDER_PATH = "spider/database"
 EMBEDDING_DIR = "schema_embeddings"
-model = SentenceTransformer("all-MiniLM-L6-v2")
+RETRIEVAL_K = 4
+
+# db_id -> (snapshot source, descriptions, RAGRetriever)
+_retrievers = {}
+_retrievers_lock = threading.Lock()
+
+def schema_retriever(db_id, db_path):
+    # Enriched schema chunks for db_id behind its (rebuilt-if-stale) chunk index. Chunks are only
+    # rebuilt and hashed when the snapshot source or the descriptions change; otherwise this is a
+    # stat() and a dict lookup. Rebuilds of one collection are serialized.
+    descriptions = load_descriptions()
+    source = get_snapshot(db_id, db_path)["source"]
+    cached = _retrievers.get(db_id)
+    if cached and cached[0] == source and cached[1] is descriptions:
+        return cached[2]
+
+    collection_name = f"schema_chunks_{db_id}"
+    with collection_lock(collection_name):
+        cached = _retrievers.get(db_id)
+        if cached and cached[0] == source and cached[1] is descriptions:
+            return cached[2]
+        schema_chunks = load_schema_chunks(db_id, db_path)
+        enriched_chunks = enrich_schema_with_descriptions(schema_chunks, db_id, descriptions)
+        retriever = RAGRetriever(collection_name=collection_name, chunks=enriched_chunks)
+        with _retrievers_lock:
+            _retrievers[db_id] = (source, descriptions, retriever)
+    return retriever
+
 def extract_sql(gpt_output):
     # Try to extract SQL block from markdown-style formatting
     if "```sql" in gpt_output.lower():
@@ -36,60 +72,73 @@ def extract_sql(gpt_output):
     return None
 
 
-def execute_sql_query(db_path, query):
+def execute_sql_query(db_path, query, timeout=SQL_TIMEOUT, max_rows=SQL_MAX_ROWS):
     try:
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-        cursor.execute(query)
-        rows = cursor.fetchall()
-        conn.close()
-        return rows
+        rows, truncated = sqlite_pool.execute(db_path, query, timeout=timeout, max_rows=max_rows)
+        if truncated:
+            print(f"✂️ Result capped at {max_rows} rows")
+        return ResultRows(rows, truncated=truncated)
     except Exception as e:
         return f"[Execution Error] {e}"
 
-from sentence_transformers import SentenceTransformer
-
-def run_query(db_id, user_question):
-    db_path = f"{SPIDER_PATH}/{db_id}/{db_id}.sqlite"
-
-    try:
-        descriptions = load_descriptions()
-        schema_chunks = load_schema_chunks(db_id, db_path)
-        enriched_chunks = enrich_schema_with_descriptions(schema_chunks, db_id, descriptions)
+# Answers that report a failure instead of a result (see run_query_with_result)
+ERROR_PREFIXES = ("[Execution Error]", "[Query blocked]", "[Error]")
 
-        retriever = RAGRetriever(collection_name=f"schema_chunks_{db_id}")
-        retriever.add_chunks(enriched_chunks)
-        retrieved_chunks = retriever.retrieve(user_question, k=4)
-
-        schema_text = " | ".join([
-            chunk.replace("\n", " ").strip()
-            for chunk in retrieved_chunks if "Table:" in chunk
-        ])
-
-        rag_prompt = f"""
-You are an expert in writing SQLite-compatible SQL queries.
+def answer_error(sql, answer):
+    # The error text of a run_query result, or None when it produced a result
+    if sql == "SQL generation failed" or str(answer).startswith(ERROR_PREFIXES):
+        return answer
+    return None
 
-Your task is to generate a query that answers the user's question based on the provided database schema.
+def run_query(db_id, user_question, question_embedding=None):
+    sql_query, answer, _ = run_query_with_result(db_id, user_question, question_embedding)
+    return sql_query, answer
 
-Rules:
-- Use only the tables and fields found in the schema.
-- Use JOINs only when necessary.
-- If filtering by a text field (like name, title, city, or country), prefer flexible matches like:
-    - `LIKE '%value%'`
-    - or `LOWER(column) LIKE '%value%'` for case-insensitive search
-- Do NOT hallucinate column or table names.
-- Keep the query concise and focused.
+def run_query_with_result(db_id, user_question, question_embedding=None, candidate_dbs=None, deadline=None):
+    # Like run_query, plus a result_id for paging the full rows (None when nothing ran).
+    # deadline (time.perf_counter()): a caller that stops waiting then (the graph's fan-out)
+    # gets no further LLM call or query started, and the SQL deadline is capped to it.
+    db_path = f"{SPIDER_PATH}/{db_id}/{db_id}.sqlite"
+    started = time.perf_counter()
+    stages = {}
+    llm_info = {}
+    guard = None
+
+    def lap(stage, since):
+        now = time.perf_counter()
+        stages[stage] = round((now - since) * 1000, 1)
+        return now
+
+    def check_deadline(stage):
+        if deadline is not None and time.perf_counter() >= deadline:
+            raise TimeoutError(f"abandoned before {stage}: caller's deadline passed")
+
+    def log(sql, answer, error=None, tokens=None):
+        log_result(
+            db_id, user_question, sql, answer, error, tokens,
+            latency_ms=(time.perf_counter() - started) * 1000,
+            stage_latencies=stages,
+            candidate_dbs=candidate_dbs,
+            cache_hits={"sql_generation": llm_info.get("cache_hit")},
+            sql_guard=guard,
+        )
 
-Schema:
-{schema_text}
+    try:
+        t = started
+        check_deadline("schema retrieval")
+        retriever = schema_retriever(db_id, db_path)
+        t = lap("schema_ms", t)
 
-Question:
-{user_question}
+        retrieved_chunks = retriever.retrieve(user_question, k=RETRIEVAL_K, query_embedding=question_embedding)
+        t = lap("retrieval_ms", t)
 
-SQL:
-""".strip()
+        rag_prompt, prompt_stats = build_sql_prompt(user_question, retrieved_chunks)
+        if prompt_stats["saved_tokens"]:
+            print(f"✂️ Prompt budget saved {prompt_stats['saved_tokens']} tokens ({prompt_stats['prompt_tokens']} sent)")
 
-        gpt_output, token_usage = run_gpt35(rag_prompt)
+        check_deadline("SQL generation")
+        gpt_output, token_usage = run_gpt35(rag_prompt, cache=CACHE_READWRITE, info=llm_info)
+        t = lap("llm_ms", t)
         print("\n🧠 GPT Output:\n", gpt_output)
 
         evaluate_sql_outputs(user_question, gpt_output, verbose=False)
@@ -98,9 +147,27 @@ SQL:
 
         if not sql_query:
             print("⚠️ No SQL generated")
-            return "SQL generation failed", "(⚠️ GPT failed to generate a valid SELECT query.)"
+            return "SQL generation failed", "(⚠️ GPT failed to generate a valid SELECT query.)", None
 
-        rows = execute_sql_query(db_path, sql_query)
+        try:
+            check_deadline("SQL execution")
+            guarded_sql, guard = guard_sql(db_id, db_path, sql_query)
+            t = lap("guard_ms", t)
+            timeout = guard["timeout"] if deadline is None else min(guard["timeout"], max(deadline - time.perf_counter(), 0.001))
+            rows = execute_sql_query(db_path, guarded_sql, timeout=timeout, max_rows=guard["max_rows"])
+        except SQLRejected as e:
+            guard = e.decision
+            t = lap("guard_ms", t)
+            rows = f"[Query blocked] {e}"
+        t = lap("sql_ms", t)
+        result_id = None
+        if isinstance(rows, list):
+            # Paging re-runs the query: keep the guard's deadline, and a downgraded query's row cap
+            result_id = result_store.register(
+                db_id, db_path, sql_query, len(rows), rows.truncated,
+                timeout=guard["timeout"],
+                max_rows=guard["max_rows"] if guard["action"] == "downgrade" else 0,
+            )
         answer = convert_sql_to_answer(rows, sql_query)
         print(f"\n🧾 Raw answer type: {type(answer)} — value: {answer}")
 
@@ -110,13 +177,13 @@ SQL:
         elif not isinstance(answer, str):
             answer = str(answer)
 
-        log_result(db_id, user_question, sql_query, answer, tokens=token_usage)
-        return sql_query, answer
+        log(sql_query, answer, tokens=token_usage)
+        return sql_query, answer, result_id
 
     except Exception as e:
         print(f"[ERROR] Exception in run_query: {e}")
-        log_result(db_id, user_question, "", "", str(e))
-        return "SQL generation failed", f"[Error] {str(e)}"
+        log("", "", str(e))
+        return "SQL generation failed", f"[Error] {str(e)}", None
 
 
 if __name__ == "__main__":
@@ -125,27 +192,14 @@ if __name__ == "__main__":
         t0 = time.time()
 
 
-        question_embedding = model.encode(user_question, convert_to_tensor=True)
-
         if len(sys.argv) == 1:
-            relevance_scores = []
-
-            for db_id in list_databases():
-                embedding_path = os.path.join(EMBEDDING_DIR, f"{db_id}.pt")
-                if not os.path.exists(embedding_path):
-                    continue
-                try:
-                    schema_embedding = torch.load(embedding_path)
-                    score = util.pytorch_cos_sim(question_embedding, schema_embedding).item()
-                    relevance_scores.append((score, db_id))
-                except Exception as e:
-                    print(f"⚠️ Skipping {db_id}: {e}")
-
-            top_dbs = sorted(relevance_scores, reverse=True)[:3]
-            
+            # Only routing needs the DB matrix; a db_id on argv skips it
+            question_embedding = encode_question(user_question)
+            top_dbs = top_k_databases(question_embedding, k=3)
+
 
             for _, db_id in top_dbs:
-                run_query(db_id, user_question)
+                run_query(db_id, user_question, question_embedding)
 
         else:
             db_id = sys.argv[1]
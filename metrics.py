@@ -0,0 +1,178 @@
+import contextvars
+import functools
+import inspect
+import threading
+import time
+from contextlib import contextmanager
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Spans of the current request when tracing was requested; None otherwise.
+# Worker threads must be started through contextvars.copy_context() to share it.
+_trace = contextvars.ContextVar("trace", default=None)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+class Counter:
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(n, "") for n in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_labels(self.label_names, key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._values = {}  # key -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(n, "") for n in self.label_names)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[i] += 1
+            entry[-2] += value
+            entry[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, entry in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, entry):
+                    lines.append(f"{self.name}_bucket{_labels(self.label_names, key, [('le', bound)])} {count}")
+                lines.append(f"{self.name}_bucket{_labels(self.label_names, key, [('le', '+Inf')])} {entry[-1]}")
+                lines.append(f"{self.name}_sum{_labels(self.label_names, key)} {entry[-2]}")
+                lines.append(f"{self.name}_count{_labels(self.label_names, key)} {entry[-1]}")
+        return lines
+
+
+SPAN_SECONDS = Histogram(
+    "text2sql_span_seconds", "Duration of pipeline spans (graph nodes, LLM, embedding, SQLite)", ("kind", "name")
+)
+SPAN_ERRORS = Counter("text2sql_span_errors_total", "Spans that raised", ("kind", "name"))
+LLM_TOKENS = Counter("text2sql_llm_tokens_total", "LLM tokens by type", ("type",))
+LLM_CALLS = Counter("text2sql_llm_calls_total", "LLM calls by cache outcome", ("cache",))
+REQUESTS = Histogram("text2sql_request_seconds", "End-to-end /query latency", ("endpoint",))
+
+_metrics = [SPAN_SECONDS, SPAN_ERRORS, LLM_TOKENS, LLM_CALLS, REQUESTS]
+# Callables returning [(metric_name, {label: value}, value)], rendered as gauges at scrape time
+_gauge_sources = []
+
+
+def register_metric(metric):
+    _metrics.append(metric)
+    return metric
+
+
+def register_gauges(source):
+    _gauge_sources.append(source)
+
+
+@contextmanager
+def span(kind, name, **attrs):
+    # Times the block into SPAN_SECONDS; attrs set on the yielded dict land in the request trace
+    started = time.perf_counter()
+    record = dict(attrs)
+    try:
+        yield record
+    except BaseException:
+        SPAN_ERRORS.inc(kind=kind, name=name)
+        record["error"] = True
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        SPAN_SECONDS.observe(elapsed, kind=kind, name=name)
+        trace = _trace.get()
+        if trace is not None:
+            trace["spans"].append({
+                "kind": kind,
+                "name": name,
+                "start_ms": round((started - trace["started"]) * 1000, 2),
+                "duration_ms": round(elapsed * 1000, 2),
+                **record,
+            })
+
+
+def traced(kind, name=None):
+    # Decorator for sync or async functions
+    def decorator(func):
+        span_name = name or func.__name__
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(kind, span_name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(kind, span_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def collect_trace(enabled=True):
+    if not enabled:
+        yield None
+        return
+    trace = {"started": time.perf_counter(), "spans": []}
+    token = _trace.set(trace)
+    try:
+        yield trace["spans"]
+    finally:
+        _trace.reset(token)
+
+
+def render():
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+
+    gauges = {}
+    for source in _gauge_sources:
+        try:
+            samples = source()
+        except Exception:
+            continue
+        for metric_name, labels, value in samples:
+            if isinstance(value, (int, float)):
+                gauges.setdefault(metric_name, []).append((labels, value))
+    for metric_name, samples in sorted(gauges.items()):
+        lines.append(f"# TYPE {metric_name} gauge")
+        for labels, value in samples:
+            lines.append(f"{metric_name}{_labels(labels.keys(), labels.values())} {value}")
+    return "\n".join(lines) + "\n"
@@ -1,22 +1,298 @@
-from openai import OpenAI
-from config import OPENAI_API_KEY
+import asyncio
+import os
+import random
+import threading
+import time
+import httpx
+from openai import OpenAI, AsyncOpenAI, APIConnectionError, APIStatusError, RateLimitError
+from config import (
+    OPENAI_API_KEY,
+    OPENAI_BASE_URL,
+    LLM_MAX_CONNECTIONS,
+    LLM_TIMEOUT,
+    LLM_REQUESTS_PER_MINUTE,
+    LLM_TOKENS_PER_MINUTE,
+    LLM_MAX_RETRIES,
+)
+from metrics import span, LLM_TOKENS, LLM_CALLS
+from llm_cache import CACHE_MODES, CACHE_OFF, CACHE_READ, CACHE_WRITE, CACHE_READWRITE, cache_key, get_llm_cache
 
-client = OpenAI(api_key=OPENAI_API_KEY)
+MODEL = "gpt-3.5-turbo"
+TEMPERATURE = 0.3
+EXPECTED_COMPLETION_TOKENS = 256
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 20.0
+RESULT_PREVIEW_ROWS = int(os.getenv("RESULT_PREVIEW_ROWS", "20"))
+MAX_CELL_CHARS = int(os.getenv("MAX_CELL_CHARS", "100"))
 
-def run_gpt35(prompt):
-    response = client.chat.completions.create(
-        model="gpt-3.5-turbo",
-        messages=[{"role": "user", "content": prompt}],
-        temperature=0.3
-    )
+_limits = httpx.Limits(max_connections=LLM_MAX_CONNECTIONS, max_keepalive_connections=LLM_MAX_CONNECTIONS)
+
+# Retries are handled here (jittered, limiter-aware), not by the SDK.
+# Clients are created on first use so importing this module opens nothing.
+_client = None
+_async_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = OpenAI(
+                    api_key=OPENAI_API_KEY,
+                    base_url=OPENAI_BASE_URL,
+                    timeout=LLM_TIMEOUT,
+                    max_retries=0,
+                    http_client=httpx.Client(limits=_limits, timeout=LLM_TIMEOUT),
+                )
+    return _client
+
+
+def get_async_client():
+    global _async_client
+    if _async_client is None:
+        _async_client = AsyncOpenAI(
+            api_key=OPENAI_API_KEY,
+            base_url=OPENAI_BASE_URL,
+            timeout=LLM_TIMEOUT,
+            max_retries=0,
+            http_client=httpx.AsyncClient(limits=_limits, timeout=LLM_TIMEOUT),
+        )
+    return _async_client
+
+
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        # Seconds until `amount` is available; a request larger than the bucket waits for a full bucket
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+
+class RateLimiter:
+    # Process-wide requests-per-minute and tokens-per-minute budget shared by sync and async callers
+
+    def __init__(self, requests_per_minute=LLM_REQUESTS_PER_MINUTE, tokens_per_minute=LLM_TOKENS_PER_MINUTE):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self._lock = threading.Lock()
+
+    def _try_acquire(self, tokens):
+        with self._lock:
+            now = time.monotonic()
+            wait = max(self.requests.wait_time(1, now), self.tokens.wait_time(tokens, now))
+            if wait <= 0:
+                self.requests.level -= 1
+                self.tokens.level -= tokens
+            return wait
+
+    def acquire(self, tokens):
+        while (wait := self._try_acquire(tokens)) > 0:
+            time.sleep(wait)
+
+    async def aacquire(self, tokens):
+        while (wait := self._try_acquire(tokens)) > 0:
+            await asyncio.sleep(wait)
+
+    def settle(self, estimated, actual):
+        # Correct the token bucket once the real usage is known
+        with self._lock:
+            self.tokens.level = min(self.tokens.capacity, self.tokens.level - (actual - estimated))
+
+
+limiter = RateLimiter()
+
+
+def estimate_tokens(prompt):
+    return len(prompt) // 4 + EXPECTED_COMPLETION_TOKENS
+
+
+def _is_retryable(error):
+    if isinstance(error, (RateLimitError, APIConnectionError)):
+        return True
+    return isinstance(error, APIStatusError) and error.status_code >= 500
+
+
+def _backoff(error, attempt):
+    retry_after = None
+    response = getattr(error, "response", None)
+    if response is not None:
+        try:
+            retry_after = float(response.headers.get("retry-after"))
+        except (TypeError, ValueError):
+            retry_after = None
+    # Full jitter so concurrent callers don't retry in lockstep
+    delay = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+    return max(delay, retry_after or 0.0)
+
+
+def _request(prompt):
+    return {
+        "model": MODEL,
+        "messages": [{"role": "user", "content": prompt}],
+        "temperature": TEMPERATURE,
+    }
+
+
+def _parse(response, record):
     content = response.choices[0].message.content.strip()
     usage = response.usage
     total_tokens = usage.prompt_tokens + usage.completion_tokens
+    record["prompt_tokens"] = usage.prompt_tokens
+    record["completion_tokens"] = usage.completion_tokens
+    LLM_TOKENS.inc(usage.prompt_tokens, type="prompt")
+    LLM_TOKENS.inc(usage.completion_tokens, type="completion")
     return content, total_tokens
 
 
+def _cache_lookup(prompt, cache):
+    # Returns (key, cached (content, tokens) or None); key is None when caching is off
+    if cache not in CACHE_MODES:
+        raise ValueError(f"Unknown cache mode: {cache}")
+    if cache == CACHE_OFF:
+        return None, None
+    key = cache_key(MODEL, TEMPERATURE, prompt)
+    if cache in (CACHE_READ, CACHE_READWRITE):
+        try:
+            return key, get_llm_cache().get(key)
+        except Exception as e:
+            print(f"⚠️ LLM cache read failed: {e}")
+    return key, None
+
 
-def convert_sql_to_answer(rows, query):
+def _cache_store(key, cache, content, total_tokens):
+    if key is None or cache not in (CACHE_WRITE, CACHE_READWRITE):
+        return
+    try:
+        get_llm_cache().set(key, MODEL, TEMPERATURE, content, total_tokens)
+    except Exception as e:
+        print(f"⚠️ LLM cache write failed: {e}")
+
+
+async def _acache_lookup(prompt, cache):
+    # The cache is SQLite: its reads and writes run in a thread, off the event loop
+    if cache == CACHE_OFF:
+        return None, None
+    return await asyncio.to_thread(_cache_lookup, prompt, cache)
+
+
+async def _acache_store(key, cache, content, total_tokens):
+    if key is None or cache not in (CACHE_WRITE, CACHE_READWRITE):
+        return
+    await asyncio.to_thread(_cache_store, key, cache, content, total_tokens)
+
+
+def run_gpt35(prompt, cache=CACHE_OFF, info=None):
+    # info: optional dict that receives {"cache_hit": bool}
+    key, hit = _cache_lookup(prompt, cache)
+    if info is not None:
+        info["cache_hit"] = hit is not None
+    LLM_CALLS.inc(cache="off" if key is None else "hit" if hit else "miss")
+    if hit:
+        return hit
+    content, total_tokens = _call_gpt35(prompt)
+    _cache_store(key, cache, content, total_tokens)
+    return content, total_tokens
+
+
+async def arun_gpt35(prompt, cache=CACHE_OFF, info=None):
+    key, hit = await _acache_lookup(prompt, cache)
+    if info is not None:
+        info["cache_hit"] = hit is not None
+    LLM_CALLS.inc(cache="off" if key is None else "hit" if hit else "miss")
+    if hit:
+        return hit
+    content, total_tokens = await _acall_gpt35(prompt)
+    await _acache_store(key, cache, content, total_tokens)
+    return content, total_tokens
+
+
+async def arun_gpt35_stream(prompt, on_delta, cache=CACHE_OFF, info=None):
+    # Like arun_gpt35, but calls on_delta(text) as completion tokens arrive.
+    # A cache hit is delivered as a single delta.
+    key, hit = await _acache_lookup(prompt, cache)
+    if info is not None:
+        info["cache_hit"] = hit is not None
+    LLM_CALLS.inc(cache="off" if key is None else "hit" if hit else "miss")
+    if hit:
+        on_delta(hit[0])
+        return hit
+    with span("llm", MODEL, stream=True) as record:
+        content, total_tokens = await _astream_gpt35_with_retries(prompt, on_delta, record)
+    await _acache_store(key, cache, content, total_tokens)
+    return content, total_tokens
+
+
+def _call_gpt35(prompt):
+    with span("llm", MODEL) as record:
+        return _call_gpt35_with_retries(prompt, record)
+
+
+async def _acall_gpt35(prompt):
+    with span("llm", MODEL) as record:
+        return await _acall_gpt35_with_retries(prompt, record)
+
+
+def _call_gpt35_with_retries(prompt, record):
+    estimated = estimate_tokens(prompt)
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        limiter.acquire(estimated)
+        try:
+            response = get_client().chat.completions.create(**_request(prompt))
+        except Exception as e:
+            if attempt == LLM_MAX_RETRIES or not _is_retryable(e):
+                raise
+            delay = _backoff(e, attempt)
+            print(f"⚠️ LLM call failed ({e.__class__.__name__}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+            continue
+        record["attempts"] = attempt + 1
+        content, total_tokens = _parse(response, record)
+        limiter.settle(estimated, total_tokens)
+        return content, total_tokens
+
+
+async def _acall_gpt35_with_retries(prompt, record):
+    estimated = estimate_tokens(prompt)
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        await limiter.aacquire(estimated)
+        try:
+            response = await get_async_client().chat.completions.create(**_request(prompt))
+        except Exception as e:
+            if attempt == LLM_MAX_RETRIES or not _is_retryable(e):
+                raise
+            delay = _backoff(e, attempt)
+            print(f"⚠️ LLM call failed ({e.__class__.__name__}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+            continue
+        record["attempts"] = attempt + 1
+        content, total_tokens = _parse(response, record)
+        limiter.settle(estimated, total_tokens)
+        return content, total_tokens
+
+
+
+def _cell(value):
+    if isinstance(value, (bytes, bytearray)):
+        return f"<blob {len(value)} bytes>"
+    text = str(value)
+    return text if len(text) <= MAX_CELL_CHARS else text[:MAX_CELL_CHARS] + "…"
+
+
+def convert_sql_to_answer(rows, query, preview_rows=RESULT_PREVIEW_ROWS):
+    # Only a bounded preview goes into the answer text (and from there into LLM prompts);
+    # the full result is served page by page from /query/{id}/rows
     if isinstance(rows, str):  # If it's an error message
         return rows
 
@@ -25,17 +301,60 @@ def convert_sql_to_answer(rows, query):
 
     # Case: Single value (e.g., SELECT COUNT(*))
     if len(rows) == 1 and len(rows[0]) == 1:
-        return f"The result is: {rows[0][0]}."
+        return f"The result is: {_cell(rows[0][0])}."
+
+    shown = rows[:preview_rows]
+    total = f"{len(rows)}+" if getattr(rows, "truncated", False) else str(len(rows))
+    footer = f"\n(showing {len(shown)} of {total} rows)" if len(shown) < len(rows) or total.endswith("+") else ""
 
     # Case: Single column, multiple rows
-    if all(len(row) == 1 for row in rows):
-        values = [str(row[0]) for row in rows]
-        return "Results:\n- " + "\n- ".join(values)
+    if all(len(row) == 1 for row in shown):
+        values = [_cell(row[0]) for row in shown]
+        return "Results:\n- " + "\n- ".join(values) + footer
 
     # Case: Multiple columns (likely grouped result)
-    header = ["Result " + str(i+1) for i in range(len(rows[0]))]
     formatted = [
-        ", ".join(map(str, row)) for row in rows
+        ", ".join(map(_cell, row)) for row in shown
     ]
-    return "Results:\n" + "\n".join(f"- {line}" for line in formatted)
+    return "Results:\n" + "\n".join(f"- {line}" for line in formatted) + footer
+
 
+async def _astream_gpt35_with_retries(prompt, on_delta, record):
+    # Retries only until the first token: after that the caller has already shown partial text
+    estimated = estimate_tokens(prompt)
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        await limiter.aacquire(estimated)
+        parts = []
+        usage = None
+        started = time.perf_counter()
+        try:
+            stream = await get_async_client().chat.completions.create(
+                **_request(prompt), stream=True, stream_options={"include_usage": True}
+            )
+            async for chunk in stream:
+                if chunk.usage is not None:
+                    usage = chunk.usage
+                if chunk.choices and chunk.choices[0].delta.content:
+                    if not parts:
+                        record["first_token_ms"] = round((time.perf_counter() - started) * 1000, 2)
+                    parts.append(chunk.choices[0].delta.content)
+                    on_delta(chunk.choices[0].delta.content)
+        except Exception as e:
+            if parts or attempt == LLM_MAX_RETRIES or not _is_retryable(e):
+                raise
+            delay = _backoff(e, attempt)
+            print(f"⚠️ LLM call failed ({e.__class__.__name__}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+            continue
+        record["attempts"] = attempt + 1
+        content = "".join(parts).strip()
+        if usage is None:
+            prompt_tokens, completion_tokens = estimated - EXPECTED_COMPLETION_TOKENS, max(1, len(content) // 4)
+        else:
+            prompt_tokens, completion_tokens = usage.prompt_tokens, usage.completion_tokens
+        record["prompt_tokens"] = prompt_tokens
+        record["completion_tokens"] = completion_tokens
+        LLM_TOKENS.inc(prompt_tokens, type="prompt")
+        LLM_TOKENS.inc(completion_tokens, type="completion")
+        limiter.settle(estimated, prompt_tokens + completion_tokens)
+        return content, prompt_tokens + completion_tokens
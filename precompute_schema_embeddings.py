@@ -1,36 +1,134 @@
+import hashlib
+import json
 import os
-import torch
-from schema_utils import load_schema_chunks
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from schema_utils import load_schema_chunks, list_databases
 from description_utils import load_descriptions, enrich_schema_with_descriptions
-from sentence_transformers import SentenceTransformer
+from embedding_service import EMBEDDING_MODEL
+from db_router import (
+    EMBEDDING_DIR, MATRIX_FILE, INDEX_FILE, save_db_matrix, load_db_matrix, load_description_matrix, _atomic_save_json,
+)
 
 SPIDER_PATH = "spider/database"
-EMBEDDING_DIR = "schema_embeddings"
-os.makedirs(EMBEDDING_DIR, exist_ok=True)
+MANIFEST_FILE = "manifest.json"
+PRECOMPUTE_BATCH_SIZE = int(os.getenv("PRECOMPUTE_BATCH_SIZE", "128"))
+# Below this many dirty databases a single process is faster than paying model load per worker
+PRECOMPUTE_SHARD_MIN = int(os.getenv("PRECOMPUTE_SHARD_MIN", "2000"))
 
-def list_databases(path=SPIDER_PATH):
-    return sorted([
-        name for name in os.listdir(path)
-        if os.path.isdir(os.path.join(path, name))
-    ])
+_model = None
 
-def compute_and_save_embeddings():
-    model = SentenceTransformer("all-MiniLM-L6-v2")
+
+def _get_model(model_name=EMBEDDING_MODEL):
+    global _model
+    if _model is None:
+        from sentence_transformers import SentenceTransformer
+        _model = SentenceTransformer(model_name)
+    return _model
+
+
+def _encode_shard(texts, model_name=EMBEDDING_MODEL, batch_size=PRECOMPUTE_BATCH_SIZE):
+    # Also the worker entry point: each process loads its own model once
+    return np.asarray(_get_model(model_name).encode(texts, batch_size=batch_size), dtype=np.float32)
+
+
+def schema_text(db_id, descriptions):
+    db_path = f"{SPIDER_PATH}/{db_id}/{db_id}.sqlite"
+    schema_chunks = load_schema_chunks(db_id, db_path)
+    enriched_chunks = enrich_schema_with_descriptions(schema_chunks, db_id, descriptions)
+    return " ".join(enriched_chunks)  # combine all chunks as one text
+
+
+def text_hash(text, model_name=EMBEDDING_MODEL):
+    return hashlib.sha256(f"{model_name}\0{text}".encode()).hexdigest()
+
+
+def load_manifest(embedding_dir=EMBEDDING_DIR):
+    try:
+        with open(os.path.join(embedding_dir, MANIFEST_FILE), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _existing_vectors(embedding_dir):
+    try:
+        matrix, db_ids = load_db_matrix(embedding_dir)
+    except (OSError, ValueError):
+        return {}
+    # Copy out of the memory map: the file is replaced below
+    return {db_id: np.array(matrix[i]) for i, db_id in enumerate(db_ids)}
+
+
+def encode_texts(texts, workers=1, batch_size=PRECOMPUTE_BATCH_SIZE):
+    if workers > 1 and len(texts) < PRECOMPUTE_SHARD_MIN:
+        print(
+            f"ℹ️ --workers {workers} ignored: {len(texts)} schemas to encode is below PRECOMPUTE_SHARD_MIN={PRECOMPUTE_SHARD_MIN}, "
+            "where one process beats loading the model in every worker (set PRECOMPUTE_SHARD_MIN lower to force sharding)"
+        )
+    if workers <= 1 or len(texts) < PRECOMPUTE_SHARD_MIN:
+        return _encode_shard(texts, batch_size=batch_size)
+
+    shard_size = -(-len(texts) // workers)
+    shards = [texts[i:i + shard_size] for i in range(0, len(texts), shard_size)]
+    print(f"🧩 Encoding {len(texts)} schemas in {len(shards)} worker processes")
+    with ProcessPoolExecutor(max_workers=len(shards)) as executor:
+        results = executor.map(_encode_shard, shards, [EMBEDDING_MODEL] * len(shards), [batch_size] * len(shards))
+        return np.concatenate(list(results))
+
+
+def compute_and_save_embeddings(force=False, workers=1, embedding_dir=EMBEDDING_DIR):
+    started = time.perf_counter()
     descriptions = load_descriptions()
+    manifest = load_manifest(embedding_dir)
+    previous = manifest.get("entries", {}) if manifest.get("model") == EMBEDDING_MODEL else {}
+    vectors = {} if force else _existing_vectors(embedding_dir)
 
+    hashes = {}
+    dirty = {}
     for db_id in list_databases():
+        db_path = f"{SPIDER_PATH}/{db_id}/{db_id}.sqlite"
+        if not os.path.exists(db_path):
+            print(f"⚠️ Skipping {db_id}: SQLite file not found.")
+            continue
         try:
-            db_path = f"{SPIDER_PATH}/{db_id}/{db_id}.sqlite"  # can be dummy if .sqlite is missing
-            schema_chunks = load_schema_chunks(db_id, db_path)
-            enriched_chunks = enrich_schema_with_descriptions(schema_chunks, db_id, descriptions)
-
-            schema_text = " ".join(enriched_chunks)  # combine all chunks as one text
-            embedding = model.encode(schema_text, convert_to_tensor=True)
-
-            torch.save(embedding, os.path.join(EMBEDDING_DIR, f"{db_id}.pt"))
-            print(f"✅ Saved embedding for {db_id}")
+            text = schema_text(db_id, descriptions)
         except Exception as e:
             print(f"❌ Failed to process {db_id}: {e}")
+            continue
+        hashes[db_id] = text_hash(text)
+        if force or previous.get(db_id) != hashes[db_id] or db_id not in vectors:
+            dirty[db_id] = text
+
+    removed = [db_id for db_id in vectors if db_id not in hashes]
+    print(f"📦 {len(hashes)} databases: {len(dirty)} to encode, {len(hashes) - len(dirty)} unchanged, {len(removed)} removed")
+
+    if dirty:
+        dirty_ids = sorted(dirty)
+        embeddings = encode_texts([dirty[db_id] for db_id in dirty_ids], workers=workers)
+        for db_id, embedding in zip(dirty_ids, embeddings):
+            vectors[db_id] = embedding
+            print(f"✅ Encoded {db_id}")
+
+    vectors = {db_id: vectors[db_id] for db_id in hashes}
+    matrix_exists = os.path.exists(os.path.join(embedding_dir, MATRIX_FILE)) and os.path.exists(os.path.join(embedding_dir, INDEX_FILE))
+    if vectors and (dirty or removed or not matrix_exists):
+        save_db_matrix(vectors, embedding_dir)
+        print(f"📐 Saved routing matrix for {len(vectors)} databases")
+
+    # Manifest last: a crash before this point leaves stale hashes, so the next run re-encodes
+    _atomic_save_json(os.path.join(embedding_dir, MANIFEST_FILE), {
+        "model": EMBEDDING_MODEL,
+        "dimension": int(next(iter(vectors.values())).shape[-1]) if vectors else None,
+        "entries": hashes,
+    })
+
+    # Description embeddings for the GPT shortlist (skipped when the content hash is unchanged)
+    load_description_matrix(descriptions, lambda texts: _encode_shard(texts), EMBEDDING_MODEL, embedding_dir)
+    print(f"⏱️ Done in {time.perf_counter() - started:.1f}s")
 
 if __name__ == "__main__":
-    compute_and_save_embeddings()
+    workers = next((int(a.split("=", 1)[1]) for a in sys.argv[1:] if a.startswith("--workers=")), 1)
+    compute_and_save_embeddings(force="--force" in sys.argv, workers=workers)
@@ -0,0 +1,140 @@
+import os
+import re
+from functools import lru_cache
+from metrics import Counter, register_metric, span
+
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "1200"))
+PROMPT_MAX_SAMPLE_CHARS = int(os.getenv("PROMPT_MAX_SAMPLE_CHARS", "160"))
+TOKENIZER_ENCODING = "cl100k_base"  # gpt-3.5-turbo / gpt-4
+
+PROMPT_TOKENS = register_metric(
+    Counter("text2sql_prompt_tokens_total", "SQL prompt tokens sent, and saved by the budget", ("kind",))
+)
+
+# Static prefix: identical bytes on every request so provider-side prefix caching can reuse it.
+# Anything request-specific (schema, question) goes after it.
+SQL_INSTRUCTIONS = """
+You are an expert in writing SQLite-compatible SQL queries.
+
+Your task is to generate a query that answers the user's question based on the provided database schema.
+
+Rules:
+- Use only the tables and fields found in the schema.
+- Use JOINs only when necessary.
+- If filtering by a text field (like name, title, city, or country), prefer flexible matches like:
+    - `LIKE '%value%'`
+    - or `LOWER(column) LIKE '%value%'` for case-insensitive search
+- Do NOT hallucinate column or table names.
+- Keep the query concise and focused.
+""".strip()
+
+
+@lru_cache(maxsize=1)
+def _encoding():
+    try:
+        import tiktoken
+        return tiktoken.get_encoding(TOKENIZER_ENCODING)
+    except Exception:
+        return None
+
+
+def count_tokens(text):
+    # Exact with tiktoken; otherwise the same ~4 chars/token estimate the rate limiter uses
+    encoding = _encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return (len(text) + 3) // 4
+
+
+def _clip(text, max_chars=PROMPT_MAX_SAMPLE_CHARS):
+    return text if len(text) <= max_chars else text[:max_chars] + "…"
+
+
+def parse_chunk(chunk):
+    # "Table: t\nColumns: ...\nSample rows:\n- ...\nDescription: ..." -> parts
+    table = {"table": None, "columns": "", "samples": [], "description": None}
+    for line in chunk.strip().split("\n"):
+        line = line.strip()
+        if line.startswith("Table:"):
+            table["table"] = line[len("Table:"):].strip()
+        elif line.startswith("Columns:"):
+            table["columns"] = line
+        elif line.startswith("Description:"):
+            table["description"] = line
+        elif line.startswith("- "):
+            table["samples"].append(line)
+    return table
+
+
+def render_table(table, samples, description):
+    parts = [f"Table: {table['table']}", table["columns"]]
+    if samples:
+        parts.append("Sample rows: " + " ".join(_clip(line) for line in table["samples"][:samples]))
+    if description and table["description"]:
+        parts.append(table["description"])
+    return " ".join(part for part in parts if part)
+
+
+def _legacy_schema_text(chunks):
+    # What run_query used to send: every retrieved table chunk, unbounded
+    return " | ".join(chunk.replace("\n", " ").strip() for chunk in chunks if "Table:" in chunk)
+
+
+def _prompt(schema_text, question):
+    return f"{SQL_INSTRUCTIONS}\n\nSchema:\n{schema_text}\n\nQuestion:\n{question}\n\nSQL:"
+
+
+def build_sql_prompt(question, chunks, budget=PROMPT_TOKEN_BUDGET):
+    # chunks in retrieval order (most relevant first). Over budget we shed, least relevant
+    # table first: sample rows, then descriptions, then whole tables (always keeping one).
+    # Returns (prompt, stats).
+    with span("prompt", "sql") as record:
+        tables = [parse_chunk(chunk) for chunk in chunks if "Table:" in chunk]
+        samples = [len(t["samples"]) for t in tables]
+        descriptions = [True] * len(tables)
+        kept = len(tables)
+
+        fixed = count_tokens(_prompt("", question))
+        costs = {}
+
+        def table_cost(i):
+            key = (i, samples[i], descriptions[i])
+            if key not in costs:
+                costs[key] = count_tokens(render_table(tables[i], samples[i], descriptions[i])) + 1
+            return costs[key]
+
+        def total():
+            return fixed + sum(table_cost(i) for i in range(kept))
+
+        for shed in ("samples", "descriptions", "tables"):
+            for i in reversed(range(kept)):
+                if total() <= budget:
+                    break
+                if shed == "samples":
+                    while samples[i] and total() > budget:
+                        samples[i] -= 1
+                elif shed == "descriptions":
+                    descriptions[i] = False
+                elif i > 0:
+                    kept = i
+
+        # Canonical (name) order keeps the schema block byte-identical across questions on the same DB
+        selected = sorted(range(kept), key=lambda i: tables[i]["table"] or "")
+        schema_text = " | ".join(render_table(tables[i], samples[i], descriptions[i]) for i in selected)
+        prompt = _prompt(schema_text, question)
+
+        prompt_tokens = count_tokens(prompt)
+        unbudgeted = count_tokens(_prompt(_legacy_schema_text(chunks), question))
+        stats = {
+            "prompt_tokens": prompt_tokens,
+            "budget": budget,
+            "saved_tokens": max(0, unbudgeted - prompt_tokens),
+            "tables": kept,
+            "dropped_tables": len(tables) - kept,
+            "dropped_samples": sum(len(t["samples"]) for t in tables[:kept]) - sum(samples[:kept]),
+            "dropped_descriptions": sum(1 for i in range(kept) if tables[i]["description"] and not descriptions[i]),
+        }
+        record.update(prompt_tokens=prompt_tokens, saved_tokens=stats["saved_tokens"])
+        PROMPT_TOKENS.inc(prompt_tokens, kind="sent")
+        PROMPT_TOKENS.inc(stats["saved_tokens"], kind="saved")
+        return prompt, stats
@@ -0,0 +1,46 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from sqlite_pool import SQL_TIMEOUT
+
+RESULT_STORE_MAX = int(os.getenv("RESULT_STORE_MAX", "10000"))
+RESULT_STORE_TTL = float(os.getenv("RESULT_STORE_TTL", "3600"))
+
+# result_id -> {"db_id", "db_path", "sql", "row_count", "truncated", "timeout", "max_rows", "created_at"}
+# timeout / max_rows are the SQL guard's limits for paging (max_rows 0: no cap beyond the page size)
+# Handles are per process; the rows are re-read from SQLite on demand, never kept here.
+# Paging therefore needs a single API worker (uvicorn without --workers): on another
+# worker the id is unknown and /query/{id}/rows answers 404.
+_results = OrderedDict()
+_lock = threading.Lock()
+
+
+def register(db_id, db_path, sql, row_count, truncated, timeout=SQL_TIMEOUT, max_rows=0):
+    result_id = hashlib.sha256(f"{db_id}\0{sql}".encode()).hexdigest()[:16]
+    now = time.time()
+    with _lock:
+        _results[result_id] = {
+            "db_id": db_id,
+            "db_path": db_path,
+            "sql": sql,
+            "row_count": row_count,
+            "truncated": truncated,
+            "timeout": timeout,
+            "max_rows": max_rows,
+            "created_at": now,
+        }
+        _results.move_to_end(result_id)
+        while len(_results) > RESULT_STORE_MAX:
+            _results.popitem(last=False)
+    return result_id
+
+
+def get(result_id):
+    with _lock:
+        entry = _results.get(result_id)
+        if entry and time.time() - entry["created_at"] > RESULT_STORE_TTL:
+            del _results[result_id]
+            return None
+        return entry
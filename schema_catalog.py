@@ -0,0 +1,81 @@
+import json
+import os
+import threading
+
+TABLES_PATH = os.path.join("spider", "tables.json")
+DESCRIPTIONS_PATH = "descriptions.json"
+
+# path -> (mtime_ns, indexed value); shared by every caller in the process
+_entries = {}
+_lock = threading.Lock()
+
+
+def _cached(path, build):
+    mtime = os.stat(path).st_mtime_ns
+    with _lock:
+        entry = _entries.get(path)
+        if entry and entry[0] == mtime:
+            return entry[1]
+
+    value = build(path)
+    with _lock:
+        _entries[path] = (mtime, value)
+    return value
+
+
+def _index_tables(path):
+    with open(path, "r") as f:
+        schemas = json.load(f)
+
+    index = {}
+    for schema in schemas:
+        tables = schema["table_names_original"]
+        column_names = schema["column_names_original"]
+
+        # Single pass over columns instead of one scan per table
+        columns = [[] for _ in tables]
+        for table_idx, column_name in column_names:
+            if table_idx >= 0:
+                columns[table_idx].append(column_name)
+
+        foreign_keys = [
+            (column_names[src][1], column_names[dst][1])
+            for src, dst in schema.get("foreign_keys", [])
+        ]
+
+        index[schema["db_id"]] = {
+            "db_id": schema["db_id"],
+            "tables": list(tables),
+            "columns": dict(zip(tables, columns)),
+            "foreign_keys": foreign_keys,
+        }
+    return index
+
+
+def _index_descriptions(path):
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def get_schema_index(path=TABLES_PATH):
+    return _cached(path, _index_tables)
+
+
+def get_db_schema(db_id, path=TABLES_PATH):
+    db_schema = get_schema_index(path).get(db_id)
+    if not db_schema:
+        raise ValueError(f"Database schema '{db_id}' not found.")
+    return db_schema
+
+
+def get_descriptions(path=DESCRIPTIONS_PATH):
+    return _cached(path, _index_descriptions)
+
+
+def get_table_descriptions(db_id, path=DESCRIPTIONS_PATH):
+    return get_descriptions(path).get(db_id, {}).get("tables", {})
+
+
+def clear():
+    with _lock:
+        _entries.clear()
@@ -0,0 +1,193 @@
+import json
+import os
+import sys
+import threading
+import sqlite_pool
+from schema_catalog import TABLES_PATH, get_schema_index
+
+SPIDER_PATH = "spider/database"
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", "schema_snapshots")
+SNAPSHOT_VERSION = 2
+SAMPLE_ROWS = 2
+SAMPLE_MAX_CELL_CHARS = int(os.getenv("SAMPLE_MAX_CELL_CHARS", "40"))
+# Column stats are computed over at most this many rows per table
+STATS_SCAN_ROWS = int(os.getenv("SNAPSHOT_STATS_ROWS", "10000"))
+
+# db_id -> snapshot dict; validated against the source stat on every lookup
+_snapshots = {}
+_lock = threading.Lock()
+
+
+def quote_identifier(name):
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def format_sample_value(value):
+    # Sample rows end up in embeddings and prompts: no blobs, no long free text
+    if isinstance(value, (bytes, bytearray)):
+        return f"<blob {len(value)} bytes>"
+    text = " ".join(str(value).split())
+    return text if len(text) <= SAMPLE_MAX_CELL_CHARS else text[:SAMPLE_MAX_CELL_CHARS] + "…"
+
+
+def _stat(path):
+    try:
+        st = os.stat(path)
+        return [st.st_mtime_ns, st.st_size]
+    except OSError:
+        return None
+
+
+def _source_key(db_path, tables_path=TABLES_PATH):
+    return {"db": _stat(db_path), "tables_json": _stat(tables_path), "version": SNAPSHOT_VERSION}
+
+
+def _structure_from_sqlite(db_path):
+    # Used for databases missing from tables.json
+    tables, columns, foreign_keys = [], {}, []
+    rows, _ = sqlite_pool.execute(
+        db_path, "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY rowid", max_rows=0
+    )
+    pks = {}
+    for (table,) in rows:
+        tables.append(table)
+        info, _ = sqlite_pool.execute(db_path, f"PRAGMA table_info({quote_identifier(table)})", max_rows=0)
+        columns[table] = [row[1] for row in info]
+        pks[table.lower()] = next((row[1] for row in info if row[5] == 1), None)
+    for table in tables:
+        fks, _ = sqlite_pool.execute(db_path, f"PRAGMA foreign_key_list({quote_identifier(table)})", max_rows=0)
+        for fk in fks:
+            # "REFERENCES other" without a column means other's primary key
+            ref_table, ref_column = fk[2], fk[4] or pks.get(fk[2].lower())
+            foreign_keys.append((f"{table}.{fk[3]}", f"{ref_table}.{ref_column}" if ref_column else ref_table))
+    return {"tables": tables, "columns": columns, "foreign_keys": foreign_keys}
+
+
+def _stat_value(value):
+    if value is None or isinstance(value, (int, float)):
+        return value
+    if isinstance(value, (bytes, bytearray)):
+        return None
+    return format_sample_value(value)
+
+
+def _column_stats(db_path, table, columns, row_count):
+    # One scan over the first STATS_SCAN_ROWS rows: min/max and a distinct count scaled to the table
+    if not columns:
+        return {}
+    selects = ", ".join(
+        f"MIN({c}), MAX({c}), COUNT(DISTINCT {c}), COUNT({c})" for c in map(quote_identifier, columns)
+    )
+    sample = f"(SELECT * FROM {quote_identifier(table)} LIMIT {STATS_SCAN_ROWS})"
+    rows, _ = sqlite_pool.execute(db_path, f"SELECT {selects} FROM {sample}", max_rows=1)
+    values = rows[0] if rows else [None] * (4 * len(columns))
+    scanned = min(row_count, STATS_SCAN_ROWS)
+
+    stats = {}
+    for i, column in enumerate(columns):
+        low, high, distinct, non_null = values[4 * i:4 * i + 4]
+        distinct = distinct or 0
+        # Near-unique in the scanned prefix: assume unique over the whole table
+        estimate = distinct if scanned >= row_count or distinct < 0.9 * scanned else round(distinct * row_count / max(scanned, 1))
+        stats[column] = {
+            "min": _stat_value(low),
+            "max": _stat_value(high),
+            "distinct_estimate": estimate,
+            "null_fraction": round(1 - (non_null or 0) / scanned, 4) if scanned else 0.0,
+        }
+    return stats
+
+
+def build_snapshot(db_id, db_path, tables_path=TABLES_PATH):
+    source = _source_key(db_path, tables_path)
+    try:
+        structure = get_schema_index(tables_path).get(db_id)
+    except OSError:
+        structure = None
+    if structure is None:
+        if source["db"] is None:
+            raise ValueError(f"Database schema '{db_id}' not found.")
+        structure = _structure_from_sqlite(db_path)
+
+    tables = []
+    for table in structure["tables"]:
+        columns = structure["columns"][table]
+        entry = {"name": table, "columns": columns, "samples": [], "row_count": None, "stats": {}}
+        if source["db"] is not None:
+            try:
+                quoted = quote_identifier(table)
+                rows, _ = sqlite_pool.execute(db_path, f"SELECT * FROM {quoted} LIMIT {SAMPLE_ROWS}", max_rows=SAMPLE_ROWS)
+                entry["samples"] = [[format_sample_value(value) for value in row] for row in rows]
+                count, _ = sqlite_pool.execute(db_path, f"SELECT COUNT(*) FROM {quoted}", max_rows=1)
+                entry["row_count"] = count[0][0]
+                entry["stats"] = _column_stats(db_path, table, columns, entry["row_count"])
+            except Exception as e:
+                print(f"⚠️ Skipping samples for table '{table}': {e}")
+        tables.append(entry)
+
+    return {
+        "db_id": db_id,
+        "source": source,
+        "tables": tables,
+        "foreign_keys": [list(fk) for fk in structure["foreign_keys"]],
+    }
+
+
+def _snapshot_path(db_id, snapshot_dir=SNAPSHOT_DIR):
+    return os.path.join(snapshot_dir, f"{db_id}.json")
+
+
+def _write(snapshot, snapshot_dir=SNAPSHOT_DIR):
+    os.makedirs(snapshot_dir, exist_ok=True)
+    path = _snapshot_path(snapshot["db_id"], snapshot_dir)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(snapshot, f, separators=(",", ":"), default=str)
+    os.replace(tmp_path, path)
+
+
+def get_snapshot(db_id, db_path, snapshot_dir=SNAPSHOT_DIR, force=False):
+    # Memory, then disk, then a one-off build; only stat() calls when the snapshot is current
+    source = _source_key(db_path)
+    with _lock:
+        snapshot = _snapshots.get(db_id)
+    if snapshot is not None and snapshot["source"] == source and not force:
+        return snapshot
+
+    snapshot = None
+    if not force:
+        try:
+            with open(_snapshot_path(db_id, snapshot_dir), "r") as f:
+                snapshot = json.load(f)
+            if snapshot.get("source") != source:
+                snapshot = None
+        except (OSError, ValueError):
+            snapshot = None
+
+    if snapshot is None:
+        snapshot = build_snapshot(db_id, db_path)
+        try:
+            _write(snapshot, snapshot_dir)
+        except OSError as e:
+            print(f"⚠️ Could not persist snapshot for {db_id}: {e}")
+
+    with _lock:
+        _snapshots[db_id] = snapshot
+    return snapshot
+
+
+def build_all(db_ids=None, force=False):
+    from schema_utils import list_databases
+    db_ids = db_ids or list_databases()
+    for db_id in db_ids:
+        db_path = f"{SPIDER_PATH}/{db_id}/{db_id}.sqlite"
+        try:
+            snapshot = get_snapshot(db_id, db_path, force=force)
+            print(f"✅ {db_id}: {len(snapshot['tables'])} tables")
+        except Exception as e:
+            print(f"❌ Failed to snapshot {db_id}: {e}")
+
+
+if __name__ == "__main__":
+    args = [a for a in sys.argv[1:] if a != "--force"]
+    build_all(args or None, force="--force" in sys.argv)
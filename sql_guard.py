@@ -0,0 +1,222 @@
+import math
+import os
+import re
+import sqlparse
+from sqlparse import tokens as T
+from sqlparse.sql import Identifier, IdentifierList, Parenthesis
+import sqlite_pool
+from sqlite_pool import SQL_TIMEOUT, SQL_MAX_ROWS
+from metrics import Counter, register_metric, span
+
+# Estimated row visits (product of nested loop sizes from EXPLAIN QUERY PLAN and snapshot row counts)
+GUARD_MAX_COST = float(os.getenv("SQL_GUARD_MAX_COST", "1e8"))         # blocked above this
+GUARD_DOWNGRADE_COST = float(os.getenv("SQL_GUARD_DOWNGRADE_COST", "1e6"))  # tighter deadline/row cap above this
+GUARD_DOWNGRADE_TIMEOUT = float(os.getenv("SQL_GUARD_DOWNGRADE_TIMEOUT", "2"))
+GUARD_DOWNGRADE_MAX_ROWS = int(os.getenv("SQL_GUARD_DOWNGRADE_MAX_ROWS", "100"))
+GUARD_EXPLAIN_TIMEOUT = float(os.getenv("SQL_GUARD_EXPLAIN_TIMEOUT", "1"))
+# Rows assumed for tables the snapshot doesn't know (subquery results, views)
+UNKNOWN_TABLE_ROWS = 1000
+PLAN_SUMMARY_STEPS = 12
+
+SQL_GUARD = register_metric(
+    Counter("text2sql_sql_guard_total", "SQL guard decisions", ("db_id", "action"))
+)
+
+# "SCAN singer", "SCAN TABLE singer AS s", "SEARCH concert USING INDEX ...", "SCAN CONSTANT ROW"
+_LOOP = re.compile(r"^(SCAN|SEARCH)(?: TABLE)? (\S+)")
+
+
+class SQLRejected(Exception):
+    # Raised for SQL that must not run; .decision is the logged guard record
+    def __init__(self, message, decision):
+        super().__init__(message)
+        self.decision = decision
+
+
+def _statement(sql):
+    # Exactly one SELECT (a WITH ... SELECT counts); returns (sql without trailing ';', parsed statement)
+    statements = [s for s in sqlparse.split(sql or "") if s.strip().rstrip(";").strip()]
+    if len(statements) != 1:
+        return None, f"expected one statement, got {len(statements)}"
+    text = statements[0].strip().rstrip(";").strip()
+    parsed = sqlparse.parse(text)[0]
+    if parsed.get_type() != "SELECT":
+        return None, f"only SELECT queries are allowed (got {parsed.get_type()})"
+    return text, parsed
+
+
+def has_limit(parsed):
+    # Top-level LIMIT only; sqlparse keeps subquery tokens inside their parentheses
+    return any(token.ttype in T.Keyword and token.normalized == "LIMIT" for token in parsed.tokens)
+
+
+def table_aliases(parsed):
+    # Plan loops are named by alias on SQLite >= 3.36 ("SCAN T1"), so map every FROM/JOIN
+    # alias (subqueries included) to its tables; unaliased tables map to themselves
+    aliases = {}
+
+    def add(identifier):
+        if not isinstance(identifier, Identifier) or isinstance(identifier.token_first(), Parenthesis):
+            return
+        name = identifier.get_real_name()
+        if name:
+            alias = identifier.get_alias() or name
+            aliases.setdefault(alias.lower(), set()).add(name.lower())
+
+    def walk(token_list):
+        previous = None
+        for token in token_list.tokens:
+            if token.is_whitespace or token.ttype in T.Comment:
+                continue
+            if previous in ("FROM", "JOIN"):
+                for identifier in token.get_identifiers() if isinstance(token, IdentifierList) else [token]:
+                    add(identifier)
+            elif previous == "ON" and isinstance(token, IdentifierList):
+                # "JOIN t ON x = y, u AS z": sqlparse lists the comma-joined tables with the condition
+                for identifier in token.get_identifiers():
+                    add(identifier)
+            previous = None
+            if token.ttype in T.Keyword:
+                previous = "JOIN" if token.normalized.endswith("JOIN") else token.normalized
+            if token.is_group:
+                walk(token)
+
+    walk(parsed)
+    return aliases
+
+
+def _row_counts(db_id, db_path):
+    try:
+        from schema_snapshot import get_snapshot
+        snapshot = get_snapshot(db_id, db_path)
+    except Exception as e:
+        print(f"⚠️ No snapshot for guard on {db_id}: {e}")
+        return {}
+    return {table["name"].lower(): table["row_count"] for table in snapshot["tables"] if table["row_count"] is not None}
+
+
+def explain(db_path, sql):
+    rows, _ = sqlite_pool.execute(db_path, f"EXPLAIN QUERY PLAN {sql}", timeout=GUARD_EXPLAIN_TIMEOUT, max_rows=0)
+    return [(row[0], row[1], row[3]) for row in rows]
+
+
+def estimate_cost(plan, row_counts, aliases=None):
+    # Sibling SCAN/SEARCH steps are nested loops, so their sizes multiply; other steps
+    # (subqueries, compound parts, materializations) add their own cost, and correlated
+    # subqueries run once per outer row. Returns (cost, full scans, nested full scans).
+    # aliases (from table_aliases) resolve plan names to tables; an alias reused for
+    # several tables is costed as the largest.
+    aliases = aliases or {}
+    children = {}
+    for node_id, parent, detail in plan:
+        children.setdefault(parent, []).append((node_id, detail))
+    full_scans, nested = [], []
+
+    def resolve(name):
+        tables = aliases.get(name.lower(), {name.lower()})
+        return max(tables, key=lambda table: row_counts.get(table, UNKNOWN_TABLE_ROWS))
+
+    def loop_size(kind, table):
+        if table == "CONSTANT":
+            return 1.0
+        rows = row_counts.get(table, UNKNOWN_TABLE_ROWS)
+        return float(max(rows, 1)) if kind == "SCAN" else math.log2(rows + 1) + 1
+
+    def cost(parent):
+        loops, outer, extra = None, 1.0, 0.0
+        for node_id, detail in children.get(parent, []):
+            match = _LOOP.match(detail)
+            if match:
+                kind, table = match.groups()
+                if table != "CONSTANT":
+                    table = resolve(table)
+                size = loop_size(kind, table)
+                if kind == "SCAN" and table != "CONSTANT":
+                    full_scans.append(table)
+                    if loops is not None and size > 1:
+                        nested.append(table)
+                loops = (loops or 1.0) * size
+                outer = loops
+                extra += cost(node_id)
+            elif detail.startswith("CORRELATED"):
+                extra += outer * cost(node_id)
+            else:
+                extra += cost(node_id)
+        return (loops or 0.0) + extra
+
+    return cost(0), full_scans, nested
+
+
+def guard_sql(db_id, db_path, sql, timeout=SQL_TIMEOUT, max_rows=SQL_MAX_ROWS):
+    # Returns (sql to execute, decision) where decision carries the timeout/max_rows to use;
+    # raises SQLRejected for non-SELECT, multi-statement or too-expensive queries
+    with span("sql_guard", db_id) as record:
+        decision = {"action": "allow", "timeout": timeout, "max_rows": max_rows}
+        text, parsed = _statement(sql)
+        if text is None:
+            decision.update(action="reject", reason=parsed)
+            return _reject(db_id, decision, record)
+
+        try:
+            plan = explain(db_path, text)
+        except Exception as e:
+            # Invalid SQL: let execution report the error as before
+            decision.update(action="error", reason=str(e))
+            return _finish(db_id, text, decision, record)
+
+        cost, full_scans, nested = estimate_cost(plan, _row_counts(db_id, db_path), table_aliases(parsed))
+        decision.update(
+            cost=round(cost),
+            full_scans=full_scans,
+            nested_full_scans=nested,
+            temp_btrees=sum(1 for _, _, detail in plan if detail.startswith("USE TEMP B-TREE")),
+            plan=[detail for _, _, detail in plan[:PLAN_SUMMARY_STEPS]],
+        )
+
+        if cost > GUARD_MAX_COST:
+            what = f"full scan of {' × '.join(full_scans)}" if nested else "plan"
+            decision.update(action="block", reason=f"estimated {cost:,.0f} row visits ({what}) exceeds {GUARD_MAX_COST:,.0f}")
+            return _reject(db_id, decision, record)
+        if cost > GUARD_DOWNGRADE_COST:
+            decision.update(
+                action="downgrade",
+                reason=f"estimated {cost:,.0f} row visits" + (f", nested full scan of {', '.join(nested)}" if nested else ""),
+                timeout=min(timeout, GUARD_DOWNGRADE_TIMEOUT),
+                max_rows=min(max_rows or GUARD_DOWNGRADE_MAX_ROWS, GUARD_DOWNGRADE_MAX_ROWS),
+            )
+
+        if not has_limit(parsed) and decision["max_rows"]:
+            # One extra row so the pool still reports truncation
+            text = f"{text}\nLIMIT {decision['max_rows'] + 1}"
+            decision["limit_injected"] = True
+            if decision["action"] == "allow":
+                decision["action"] = "limit"
+        return _finish(db_id, text, decision, record)
+
+
+def _finish(db_id, sql, decision, record):
+    SQL_GUARD.inc(db_id=db_id, action=decision["action"])
+    record.update(action=decision["action"], cost=decision.get("cost"))
+    if decision["action"] == "downgrade":
+        print(f"🛡️ Downgraded query on {db_id}: {decision['reason']} (timeout {decision['timeout']:g}s, {decision['max_rows']} rows)")
+    return sql, decision
+
+
+def _reject(db_id, decision, record):
+    SQL_GUARD.inc(db_id=db_id, action=decision["action"])
+    record.update(action=decision["action"], cost=decision.get("cost"))
+    print(f"🛡️ Blocked query on {db_id}: {decision['reason']}")
+    raise SQLRejected(decision["reason"], decision)
+
+
+if __name__ == "__main__":
+    # Self-check: python sql_guard.py. An aliased cross join of two large tables must be
+    # blocked; SQLite >= 3.36 names its plan loops T1/T2, not a/b.
+    import sqlite3
+    conn = sqlite3.connect(":memory:")
+    conn.executescript("CREATE TABLE a (id INTEGER PRIMARY KEY, x); CREATE TABLE b (id INTEGER PRIMARY KEY, y);")
+    for sql in ("SELECT * FROM a AS T1, b AS T2", "SELECT * FROM a T1 CROSS JOIN b T2"):
+        plan = [(row[0], row[1], row[3]) for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}")]
+        cost, full_scans, nested = estimate_cost(plan, {"a": 20000, "b": 30000}, table_aliases(_statement(sql)[1]))
+        assert cost > GUARD_MAX_COST and sorted(full_scans) == ["a", "b"], (sql, plan, cost, full_scans)
+        print(f"✅ {sql}: {cost:,.0f} estimated row visits over {' × '.join(full_scans)} → blocked")
@@ -0,0 +1,190 @@
+import os
+import queue
+import sqlite3
+import threading
+import time
+from urllib.parse import quote
+from metrics import span
+
+SQLITE_POOL_SIZE = int(os.getenv("SQLITE_POOL_SIZE", "4"))
+SQL_TIMEOUT = float(os.getenv("SQL_TIMEOUT", "10"))
+SQL_MAX_ROWS = int(os.getenv("SQL_MAX_ROWS", "1000"))
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+SQLITE_CACHE_KB = int(os.getenv("SQLITE_CACHE_KB", "16384"))
+PROGRESS_INTERVAL = 1000  # SQLite VM instructions between deadline checks
+
+
+class QueryTimeout(Exception):
+    pass
+
+
+class PoolExhausted(QueryTimeout):
+    # Every connection to the database stayed checked out past the query deadline
+    pass
+
+
+class ResultRows(list):
+    # A plain list of rows that also remembers whether SQL_MAX_ROWS cut it short
+    def __init__(self, rows=(), truncated=False):
+        super().__init__(rows)
+        self.truncated = truncated
+
+
+def _connect(db_path):
+    # mode=ro fails on a missing file instead of silently creating an empty database
+    conn = sqlite3.connect(f"file:{quote(os.path.abspath(db_path))}?mode=ro", uri=True, check_same_thread=False)
+    conn.execute("PRAGMA query_only = ON")
+    conn.execute(f"PRAGMA mmap_size = {SQLITE_MMAP_SIZE}")
+    conn.execute(f"PRAGMA cache_size = -{SQLITE_CACHE_KB}")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    return conn
+
+
+class ConnectionPool:
+    def __init__(self, db_path, size=SQLITE_POOL_SIZE):
+        self.db_path = db_path
+        self.db_id = os.path.splitext(os.path.basename(db_path))[0]
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "queries": 0,
+            "errors": 0,
+            "timeouts": 0,
+            "exhausted": 0,
+            "truncated": 0,
+            "latency_seconds_total": 0.0,
+            "latency_seconds_max": 0.0,
+        }
+
+    def acquire(self, timeout=SQL_TIMEOUT):
+        try:
+            conn = self._idle.get_nowait()
+            self._count("hits")
+            return conn
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            create = self._created < self.size
+            if create:
+                self._created += 1
+        if create:
+            self._count("misses")
+            try:
+                return _connect(self.db_path)
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        # Pool exhausted: wait for a connection to come back, but not past the query deadline
+        try:
+            conn = self._idle.get(timeout=max(timeout, 0))
+        except queue.Empty:
+            self._count("exhausted")
+            raise PoolExhausted(
+                f"all {self.size} connections to {self.db_id} busy for {timeout:g}s (SQLITE_POOL_SIZE)"
+            ) from None
+        self._count("hits")
+        return conn
+
+    def release(self, conn):
+        self._idle.put(conn)
+
+    def _count(self, key, amount=1):
+        with self._lock:
+            self.stats[key] += amount
+
+    def execute(self, query, params=(), timeout=SQL_TIMEOUT, max_rows=SQL_MAX_ROWS):
+        # Returns (rows, truncated). Raises QueryTimeout past the deadline.
+        with span("sqlite", self.db_id) as record:
+            rows, truncated, _ = self._execute(query, params, timeout, max_rows)
+            record["rows"] = len(rows)
+            return rows, truncated
+
+    def _execute(self, query, params, timeout, max_rows):
+        # Time spent waiting for a connection counts against the deadline
+        started = time.perf_counter()
+        deadline = started + timeout
+        conn = self.acquire(timeout)
+        conn.set_progress_handler(lambda: 1 if time.perf_counter() > deadline else 0, PROGRESS_INTERVAL)
+        error = None
+        try:
+            cursor = conn.execute(query, params)
+            rows = cursor.fetchmany(max_rows + 1) if max_rows else cursor.fetchall()
+            columns = [column[0] for column in cursor.description or ()]
+            cursor.close()
+        except sqlite3.OperationalError as e:
+            error = QueryTimeout(f"query exceeded {timeout:g}s deadline") if "interrupted" in str(e) else e
+        except Exception as e:
+            error = e
+        finally:
+            conn.set_progress_handler(None, 0)
+            self.release(conn)
+
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self.stats["queries"] += 1
+            self.stats["latency_seconds_total"] += elapsed
+            self.stats["latency_seconds_max"] = max(self.stats["latency_seconds_max"], elapsed)
+            if error is not None:
+                self.stats["timeouts" if isinstance(error, QueryTimeout) else "errors"] += 1
+        if error is not None:
+            raise error
+
+        truncated = bool(max_rows) and len(rows) > max_rows
+        if truncated:
+            rows = rows[:max_rows]
+            self._count("truncated")
+        return rows, truncated, columns
+
+    def snapshot(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["connections"] = self._created
+        checkouts = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / checkouts if checkouts else 0.0
+        stats["latency_seconds_mean"] = stats["latency_seconds_total"] / stats["queries"] if stats["queries"] else 0.0
+        return stats
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(db_path):
+    pool = _pools.get(db_path)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(db_path)
+            if pool is None:
+                pool = _pools[db_path] = ConnectionPool(db_path)
+    return pool
+
+
+def execute(db_path, query, params=(), timeout=SQL_TIMEOUT, max_rows=SQL_MAX_ROWS):
+    return get_pool(db_path).execute(query, params, timeout=timeout, max_rows=max_rows)
+
+
+def stream(db_path, query, params=(), offset=0, limit=None, chunk_size=500, timeout=SQL_TIMEOUT):
+    # Yields the column names, then lists of up to chunk_size rows from query's [offset, offset + limit)
+    # window. The window is one query, fetched in one go, so the connection is back in the pool
+    # before the first row goes out and a slow reader never holds it.
+    pool = get_pool(db_path)
+    paged = f"SELECT * FROM ({query.strip().rstrip(';')}) LIMIT ? OFFSET ?"
+    with span("sqlite", pool.db_id) as record:
+        rows, _, columns = pool._execute(paged, (*params, -1 if limit is None else limit, offset), timeout, 0)
+        record["rows"] = len(rows)
+    yield columns
+    for start in range(0, len(rows), chunk_size):
+        yield rows[start:start + chunk_size]
+
+
+def pool_stats():
+    with _pools_lock:
+        pools = list(_pools.values())
+    return {pool.db_id: pool.snapshot() for pool in pools}
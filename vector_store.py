@@ -1,44 +1,135 @@
-from chromadb import Client
-import chromadb.config
-from sentence_transformers import SentenceTransformer, util
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+from embedding_service import EMBEDDING_MODEL, get_embedding_service
+
+CHUNK_INDEX_DIR = "chunk_index"
+RETRIEVAL_CACHE_SIZE = int(os.getenv("RETRIEVAL_CACHE_SIZE", "4096"))
+
+_client = None
+# (collection, content hash, k, embedding digest) -> documents; filled by retrieve_many for batches
+_retrieved = OrderedDict()
+_retrieved_lock = threading.Lock()
+# collection name -> RLock; a rebuild deletes and recreates the collection, so one at a time
+_collection_locks = {}
+_collection_locks_lock = threading.Lock()
+
+
+def get_client(path=CHUNK_INDEX_DIR):
+    global _client
+    if _client is None:
+        import chromadb  # heavy; only once a chunk index is actually needed
+        _client = chromadb.PersistentClient(path=path)
+    return _client
+
+
+def chunks_hash(chunks):
+    h = hashlib.sha256(EMBEDDING_MODEL.encode())
+    for chunk in chunks:
+        h.update(chunk.encode())
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def collection_lock(collection_name):
+    with _collection_locks_lock:
+        return _collection_locks.setdefault(collection_name, threading.RLock())
+
+
+def build_chunk_index(collection_name, chunks, force=False):
+    # Embed chunks into a persistent collection unless it is already current.
+    # Returns True when the collection was (re)built.
+    with collection_lock(collection_name):
+        return _build_chunk_index(collection_name, chunks, force)
+
+
+def _build_chunk_index(collection_name, chunks, force):
+    client = get_client()
+    content_hash = chunks_hash(chunks)
+
+    try:
+        collection = client.get_collection(name=collection_name)
+        if not force and (collection.metadata or {}).get("content_hash") == content_hash:
+            return False
+        client.delete_collection(name=collection_name)
+    except Exception:
+        pass
+
+    collection = client.create_collection(
+        name=collection_name,
+        metadata={"hnsw:space": "cosine", "content_hash": content_hash},
+    )
+    if chunks:
+        embeddings = get_embedding_service().encode(chunks, normalize=True)
+        collection.add(
+            documents=list(chunks),
+            embeddings=embeddings.tolist(),
+            metadatas=[{"chunk_id": i} for i in range(len(chunks))],
+            ids=[f"{content_hash[:12]}-{i}" for i in range(len(chunks))],
+        )
+    return True
+
 
 class RAGRetriever:
-    def __init__(self, collection_name="schema_chunks"):
-        self.client = Client(settings=chromadb.config.Settings(allow_reset=True))
-        if collection_name in [col.name for col in self.client.list_collections()]:
-            self.collection = self.client.get_collection(name=collection_name)
-        else:
-            self.collection = self.client.create_collection(name=collection_name)
+    def __init__(self, collection_name="schema_chunks", chunks=None):
+        # Opening is cheap; embedding only happens when the stored hash is stale
+        with collection_lock(collection_name):
+            if chunks is not None and build_chunk_index(collection_name, chunks):
+                print(f"🔄 Rebuilt chunk index: {collection_name}")
+            self.collection = get_client().get_or_create_collection(
+                name=collection_name, metadata={"hnsw:space": "cosine"}
+            )
+        self.collection_name = collection_name
+        self.content_hash = (self.collection.metadata or {}).get("content_hash")
+        self.embedder = get_embedding_service()
 
-        self.embedder = SentenceTransformer("all-MiniLM-L6-v2")
+    def _key(self, query_embedding, k):
+        digest = hashlib.sha1(np.asarray(query_embedding, dtype=np.float32).tobytes()).hexdigest()
+        return (self.collection_name, self.content_hash, k, digest)
 
     def add_chunks(self, chunks):
-        documents = []
-        metadatas = []
-        ids = []
-
-        for i, chunk in enumerate(chunks):
-            documents.append(chunk)
-            metadatas.append({"chunk_id": i})
-            ids.append(str(i))
-
-        self.collection.add(
-            documents=documents,
-            metadatas=metadatas,
-            ids=ids
-        )
+        with collection_lock(self.collection_name):
+            build_chunk_index(self.collection_name, chunks)
+            self.collection = get_client().get_collection(name=self.collection_name)
+        self.content_hash = (self.collection.metadata or {}).get("content_hash")
+
+    def retrieve(self, query, k=3, query_embedding=None):
+        if query_embedding is None:
+            query_embedding = self.embedder.encode(query, normalize=True)
+        return self.retrieve_many([query_embedding], k)[0]
+
+    def retrieve_many(self, query_embeddings, k=3):
+        # One collection query for every embedding not already cached
+        keys = [self._key(embedding, k) for embedding in query_embeddings]
+        with _retrieved_lock:
+            documents = [_retrieved.get(key) for key in keys]
+            for key, docs in zip(keys, documents):
+                if docs is not None:
+                    _retrieved.move_to_end(key)
+        missing = [i for i, docs in enumerate(documents) if docs is None]
+        if not missing:
+            return documents
 
-    def retrieve(self, query, k=3):
-        query_embedding = self.embedder.encode(query).tolist()
+        count = self.collection.count()
+        if count == 0:
+            return [docs or [] for docs in documents]
         results = self.collection.query(
-            query_embeddings=[query_embedding],
-            n_results=k
+            query_embeddings=[np.asarray(query_embeddings[i], dtype=np.float32).tolist() for i in missing],
+            n_results=min(k, count)
         )
-        return results["documents"][0]
+        with _retrieved_lock:
+            for i, docs in zip(missing, results["documents"]):
+                documents[i] = docs
+                _retrieved[keys[i]] = docs
+                _retrieved.move_to_end(keys[i])
+            while len(_retrieved) > RETRIEVAL_CACHE_SIZE:
+                _retrieved.popitem(last=False)
+        return documents
 
     def relevance_score(self, query):
-        query_embedding = self.embedder.encode(query, convert_to_tensor=True)
         docs = self.collection.get()["documents"]
         schema_text = " ".join(docs)
-        schema_embedding = self.embedder.encode(schema_text, convert_to_tensor=True)
-        return util.pytorch_cos_sim(query_embedding, schema_embedding).item()
+        query_embedding, schema_embedding = self.embedder.encode([query, schema_text], normalize=True)
+        return float(np.dot(query_embedding, schema_embedding))
@@ -0,0 +1,125 @@
+# Explicit warm-up: loads everything the first request would otherwise pay for.
+# Importing this module is cheap; each step imports its own heavy dependencies.
+#
+#   python warmup.py            # run every step and print timings
+import os
+import threading
+import time
+
+WARMUP_ON_STARTUP = os.getenv("WARMUP_ON_STARTUP", "1") == "1"
+# Failed required steps are retried in the background, backing off from the first delay to the max
+WARMUP_RETRY_SECONDS = float(os.getenv("WARMUP_RETRY_SECONDS", "5"))
+WARMUP_RETRY_MAX_SECONDS = float(os.getenv("WARMUP_RETRY_MAX_SECONDS", "300"))
+
+# step name -> {"state": pending|running|ok|failed, "required", "attempts", "seconds", "error"}
+_status = {}
+_lock = threading.Lock()
+_thread = None
+
+
+def _embedding_model():
+    # Loads the model and runs one forward pass (the first one is much slower than the rest)
+    from embedding_service import get_embedding_service
+    get_embedding_service().encode("warm up")
+
+
+def _routing_matrix():
+    from db_router import load_db_matrix
+    matrix, db_ids = load_db_matrix()
+    print(f"📐 Routing matrix mapped: {len(db_ids)} databases × {matrix.shape[1]} dims")
+
+
+def _schema_catalog():
+    from hint_index import get_hint_index
+    get_hint_index()
+
+
+def _chunk_index():
+    from vector_store import get_client
+    get_client()
+
+
+def _llm_client():
+    from model_runner import get_client, get_async_client
+    get_client()
+    get_async_client()
+
+
+def _results_log():
+    from logger import init_csv_log
+    init_csv_log()
+
+
+# (name, function, required for readiness). The routing matrix and catalog are optional:
+# routing falls back without them and they only exist once precompute has run.
+WARMUP_STEPS = [
+    ("embedding_model", _embedding_model, True),
+    ("routing_matrix", _routing_matrix, False),
+    ("schema_catalog", _schema_catalog, False),
+    ("chunk_index", _chunk_index, True),
+    ("llm_client", _llm_client, True),
+    ("results_log", _results_log, True),
+]
+
+
+def _set(name, **fields):
+    with _lock:
+        _status[name].update(fields)
+
+
+def _run_step(name, step):
+    with _lock:
+        _status[name].update(state="running", attempts=_status[name].get("attempts", 0) + 1)
+    step_started = time.perf_counter()
+    try:
+        step()
+        _set(name, state="ok", seconds=round(time.perf_counter() - step_started, 3), error=None)
+        return True
+    except Exception as e:
+        _set(name, state="failed", seconds=round(time.perf_counter() - step_started, 3), error=str(e))
+        print(f"⚠️ Warm-up step {name} failed: {e}")
+        return False
+
+
+def warm_up(extra_steps=(), retry=False):
+    # extra_steps run first, e.g. the API's graph build. With retry, failed required steps
+    # are rerun with backoff until they succeed, so one transient error doesn't keep
+    # /readyz at 503 until a restart.
+    steps = list(extra_steps) + WARMUP_STEPS
+    with _lock:
+        for name, _, required in steps:
+            _status[name] = {"state": "pending", "required": required}
+
+    started = time.perf_counter()
+    failed = [(name, step) for name, step, required in steps if not _run_step(name, step) and required]
+    print(f"🔥 Warm-up finished in {time.perf_counter() - started:.2f}s")
+
+    delay = WARMUP_RETRY_SECONDS
+    while retry and failed:
+        print(f"🔁 Retrying {', '.join(name for name, _ in failed)} in {delay:g}s")
+        time.sleep(delay)
+        failed = [(name, step) for name, step in failed if not _run_step(name, step)]
+        delay = min(delay * 2, WARMUP_RETRY_MAX_SECONDS)
+    return readiness()
+
+
+def start_warm_up(extra_steps=()):
+    # Runs in the background so the server answers /healthz while models load
+    global _thread
+    with _lock:
+        if _thread is None:
+            _thread = threading.Thread(target=warm_up, args=(extra_steps, True), name="warm-up", daemon=True)
+            _thread.start()
+    return _thread
+
+
+def readiness():
+    with _lock:
+        steps = {name: dict(status) for name, status in _status.items()}
+    ready = bool(steps) and all(s["state"] == "ok" for s in steps.values() if s["required"])
+    return {"ready": ready, "steps": steps}
+
+
+if __name__ == "__main__":
+    for name, status in warm_up()["steps"].items():
+        print(f"{name:<16} {status['state']:<7} {status.get('seconds', 0):7.3f}s {status.get('error') or ''}")